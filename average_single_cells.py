@@ -29,174 +29,341 @@ along with this program.  If not, see
 <https://www.gnu.org/licenses/>.
 '''
 
+from util import packageGeneMatrix
+from util import add_format_argument
+import instrument
 import numpy as np
-import csv
 import os
+import re
+import json
 import argparse
-from scipy import stats
+from operator import itemgetter
+from multiprocessing import Pool
+
+# Columns extracted from the Morphologist feature files: (header name, field name, type)
+# Cell types are kept as single characters ('m' for mothers, 'b' for buds), and the five DST means are kept together
+# as one (cells x 5) float field, in the order the features are written to the output
+COLUMNS = [("CellID", "cell_id", np.int64),
+           ("Area", "area", np.float64),
+           ("Cell_type", "cell_type", "S1"),
+           ("Cell_prob", "cell_prob", np.float64),
+           ("Rel_Cell_ID", "rel_cell_id", np.int64),
+           ("Intensity_MEAN", "intensity_mean", np.float64)]
+DST_COLUMNS = ["N_SELF_DST_MEAN", "N_MASC_DST_MEAN", "N_EDGE_DST_MEAN", "N_CENT_DST_MEAN", "N_BUDN_DST_MEAN"]
+FEATURE_DTYPE = np.dtype([(field, dtype) for _, field, dtype in COLUMNS] + [("dst", np.float64, (len(DST_COLUMNS),))])
+
+MOTHER = b'm'
+BUD = b'b'
 
 def extract_columns(rawData):
-    '''Given a full feature matrix, extracts only the relevant features. Extracts:
-    CellID, Area, Cell_Type, Rel_Cell_ID, Cell_Prob,
+    '''Given a full feature file, parses only the relevant features into a typed record array. Extracts:
+    CellID, Area, Cell_Type, Cell_Prob, Rel_Cell_ID,
     Intensity_Mean, N_Self_DST_Mean, N_Masc_DST_Mean,
-    N_Edge_DST_Mean, N_Cent_DST_Mean, N_Budn_DST_Mean'''
-    file = open(rawData)
-    list = csv.reader(file, delimiter='\t')
-    matrix = np.array([row for row in list])
+    N_Edge_DST_Mean, N_Cent_DST_Mean, N_Budn_DST_Mean
+    Columns are located by their header name; the DST means are stored together in the "dst" field.'''
+    with open(rawData) as file:
+        headers = file.readline().rstrip("\r\n").split("\t")
+        names = [name for name, _, _ in COLUMNS] + DST_COLUMNS
+        try:
+            indices = [headers.index(name) for name in names]
+        except ValueError:
+            missing = [name for name in names if name not in headers]
+            raise ValueError("Missing columns in feature file " + rawData + ": " + ", ".join(missing))
 
-    features = matrix[:, [1, 13, 21, 38, 42, 71, 75, 79, 83, 87, 91]]
+        # Keep only the needed columns of each row as it is read, then transpose into one tuple of strings per column
+        select = itemgetter(*indices)
+        rows = [select(line.rstrip("\r\n").split("\t")) for line in file if line.strip() != ""]
+        columns = list(zip(*rows)) if len(rows) > 0 else [()] * len(indices)
+
+    features = np.empty(len(rows), dtype=FEATURE_DTYPE)
+    for i, (_, field, dtype) in enumerate(COLUMNS):
+        features[field] = np.array(columns[i], dtype=dtype)
+    for i in range(0, len(DST_COLUMNS)):
+        features["dst"][:, i] = np.array(columns[len(COLUMNS) + i], dtype=np.float64)
     return features
 
+# Bins are based upon bud size, and are calculated in Handfield et al. 2013
+# We merged adjacent bins compared to this paper
+BIN_EDGES = np.array([430.43, 683.26, 895.33, 1084.61])
+NUM_BINS = len(BIN_EDGES) + 1
+
+# Names of the (cell type, bin) groups, in the order their truncated means are written for each feature
+CELL_TYPES = [BUD, MOTHER]
+BIN_NAMES = [cell_type.decode().upper() + str(bin) for cell_type in CELL_TYPES for bin in range(0, NUM_BINS)]
+
 def assign_bins(features):
-    '''Given the 10 filtered features, assign each bud and mother a bin.
+    '''Given the filtered features, assign each bud and mother a bin.
     Outputs an 2D array of bins, where index of array corresponds to CellID.'''
-    bins = np.zeros((int(features[-1][0]) + 1))
-    length = features.shape[0]
-
-    # Bins are based upon bud size, and are calculated in Handfield et al. 2013
-    # We merged adjacent bins compared to this paper
-    for i in range(1, length):
-        if (features[i][2] == 'b'):
-            area = float(features[i][1])
-            if (area >= 0 and area < 430.43):
-                bins[int(features[i][0])] = 1
-                bins[int(features[i][4])] = 1
-            if (area >= 430.43 and area < 683.26):
-                bins[int(features[i][0])] = 2
-                bins[int(features[i][4])] = 2
-            if (area >= 683.26 and area < 895.33):
-                bins[int(features[i][0])] = 3
-                bins[int(features[i][4])] = 3
-            if (area >= 895.33 and area < 1084.61):
-                bins[int(features[i][0])] = 4
-                bins[int(features[i][4])] = 4
-            if (area >= 1084.61):
-                bins[int(features[i][0])] = 5
-                bins[int(features[i][4])] = 5
+    bins = np.zeros((int(features["cell_id"].max()) + 1))
+
+    # Bin each bud by its area, and give its mother (Rel_Cell_ID) the same bin
+    buds = features[(features["cell_type"] == BUD) & (features["area"] >= 0)]
+    bud_bins = np.digitize(buds["area"], BIN_EDGES) + 1
+
+    # Interleave buds and mothers, so that later cells overwrite earlier ones in file order
+    cells = np.column_stack((buds["cell_id"], buds["rel_cell_id"])).ravel()
+    bins[cells] = np.repeat(bud_bins, 2)
 
     return bins
 
+def trimmed_means(values, proportiontocut=0.05):
+    '''Truncated mean of each row of a 2D array, computed the same way as stats.trim_mean on each row so that the
+    results are identical.'''
+    nobs = values.shape[1]
+    lowercut = int(proportiontocut * nobs)
+    uppercut = nobs - lowercut
+    values = np.partition(values, (lowercut, uppercut - 1), axis=1)
+    return np.mean(values[:, lowercut:uppercut], axis=1)
+
+def bin_cells(features, bins):
+    '''Given the filtered features and bins, find the (cell type, bin) group of each binned cell.
+    Outputs the group of each binned cell (an index into BIN_NAMES) and its DST means, in order of CellID.'''
+    # Take the first occurrence of each binned cell, in order of CellID
+    cell_ids, index = np.unique(features["cell_id"], return_index=True)
+    keep = (cell_ids > 0) & (cell_ids < bins.shape[0])
+    cell_ids = cell_ids[keep]
+    index = index[keep]
+    cell_bins = bins[cell_ids].astype(np.int64)
+
+    # Group cells by (cell type, bin) - buds come first, then mothers
+    cell_types = features["cell_type"][index]
+    group = np.full(len(index), -1)
+    for i, cell_type in enumerate(CELL_TYPES):
+        group[cell_type == cell_types] = i * NUM_BINS + cell_bins[cell_type == cell_types] - 1
+    binned = (cell_bins != 0) & (group >= 0)
+    return group[binned], features["dst"][index[binned]]
+
+def tmean_groups(group, values):
+    '''Truncated means of the DST means of cells grouped by (cell type, bin).
+    Outputs the list of truncated means (empty if any bin has no cells), and the names of the empty bins.'''
+    # A stable sort keeps cells in their original order within each group
+    order = np.argsort(group, kind="stable")
+    counts = np.bincount(group, minlength=len(BIN_NAMES))
+    empty = [BIN_NAMES[i] for i in range(0, len(BIN_NAMES)) if counts[i] == 0]
+    if len(empty) > 0:
+        return [], empty
+
+    # Truncated mean of every feature in every group, laid out as feature-major (feature, group)
+    values = values[order]
+    tmeans = np.zeros((len(DST_COLUMNS), len(BIN_NAMES)))
+    start = 0
+    for i in range(0, len(BIN_NAMES)):
+        tmeans[:, i] = trimmed_means(np.ascontiguousarray(values[start:start + counts[i]].T))
+        start += counts[i]
+
+    return tmeans.ravel().tolist(), empty
+
 def tmean_bins(features, bins):
     '''Return all single-cell data in a bin as a truncated mean (0.05% trim off tails)
-    N_Self_DST_Mean, N_Masc_DST_Mean, N_Edge_DST_Mean, N_Cent_DST_Mean, N_Budn_DST_Mean'''
-    m0 = []
-    m1 = []
-    m2 = []
-    m3 = []
-    m4 = []
-    b0 = []
-    b1 = []
-    b2 = []
-    b3 = []
-    b4 = []
-
-    # Sort single cells into bins
-    for i in range(1, bins.shape[0]):
-        if (bins[i] != 0):
-            index = np.where(features[:, 0] == str(i))[0][0]
-            bin = bins[i]
-            type = features[index][2]
-            if (type == 'm' and bin == 1):
-                m0.append(features[index])
-            if (type == 'm' and bin == 2):
-                m1.append(features[index])
-            if (type == 'm' and bin == 3):
-                m2.append(features[index])
-            if (type == 'm' and bin == 4):
-                m3.append(features[index])
-            if (type == 'm' and bin == 5):
-                m4.append(features[index])
-            if (type == 'b' and bin == 1):
-                b0.append(features[index])
-            if (type == 'b' and bin == 2):
-                b1.append(features[index])
-            if (type == 'b' and bin == 3):
-                b2.append(features[index])
-            if (type == 'b' and bin == 4):
-                b3.append(features[index])
-            if (type == 'b' and bin == 5):
-                b4.append(features[index])
-    b0 = np.array(b0)
-    b1 = np.array(b1)
-    b2 = np.array(b2)
-    b3 = np.array(b3)
-    b4 = np.array(b4)
-    m0 = np.array(m0)
-    m1 = np.array(m1)
-    m2 = np.array(m2)
-    m3 = np.array(m3)
-    m4 = np.array(m4)
-
-    tmean_features = []
+    N_Self_DST_Mean, N_Masc_DST_Mean, N_Edge_DST_Mean, N_Cent_DST_Mean, N_Budn_DST_Mean
+    Outputs the list of truncated means (empty if any bin has no cells); use tmean_groups for the empty bins.'''
+    group, values = bin_cells(features, bins)
+    return tmean_groups(group, values)[0]
+
+# Headers of the averaged features file
+HEADERS = ["ImageName", "SEF_B0", "SEF_B1", "SEF_B2", "SEF_B3", "SEF_B4", "SEF_M0", "SEF_M1",
+           "SEF_M2", "SEF_M3", "SEF_M4", "MCT_B0", "MCT_B1", "MCT_B2", "MCT_B3", "MCT_B4", "MCT_M0",
+           "MCT_M1", "MCT_M2", "MCT_M3", "MCT_M4", "EDG_B0", "EDG_B1", "EDG_B2", "EDG_B3", "EDG_B4",
+           "EDG_M0", "EDG_M1", "EDG_M2", "EDG_M3", "EDG_M4", "CEN_B0", "CEN_B1", "CEN_B2", "CEN_B3",
+           "CEN_B4", "CEN_M0", "CEN_M1", "CEN_M2", "CEN_M3", "CEN_M4", "NEC_B0", "NEC_B1", "NEC_B2",
+           "NEC_B3", "NEC_B4", "NEC_M0", "NEC_M1", "NEC_M2", "NEC_M3", "NEC_M4"]
+
+def average_files(name, filepaths):
+    '''Calculates the truncated means of one or more single-cell features files (e.g. several fields of view of the
+    same strain), pooling the binned cells of all files. Only the DST means of binned cells are kept from each file,
+    so memory is bounded by the number of cells in the pool rather than the size of the files.
+    Outputs the name, list of truncated means (empty if skipped), and a list of messages for skipped files.'''
+    with instrument.stage("average/unit", files=len(filepaths)):
+        return _average_files(name, filepaths)
+
+def _average_files(name, filepaths):
+    '''Calculates the truncated means of one unit of files (see average_files).'''
+    groups = []
+    values = []
+    messages = []
+    for filepath in filepaths:
+        file = os.path.basename(filepath)
+        try:
+            features = extract_columns(filepath)
+            group, dst = bin_cells(features, assign_bins(features))
+        except (ValueError, IndexError, OSError) as e:
+            messages.append("ERROR: Could not process file in directory - skipped " + file + " (" + str(e) + ")")
+            continue
+        groups.append(group)
+        values.append(dst)
+
+    if len(groups) == 0:
+        return name, [], messages
+    instrument.count(cells=sum(len(group) for group in groups))
+    final_features, empty = tmean_groups(np.concatenate(groups), np.concatenate(values))
+    if final_features == []:
+        messages.append("File skipped: Not enough valid cells in " + ", ".join(os.path.basename(filepath) for filepath
+                        in filepaths) + " (empty bins: " + ", ".join(empty) + ")")
+    return name, final_features, messages
+
+def bootstrap_groups(group, values, resamples, seed=None):
+    '''Truncated means of cells grouped by (cell type, bin) like tmean_groups, for resamples of the cells drawn with
+    replacement within each group (so no bin is ever empty). All resamples of a group are computed at once.
+    Outputs a (resamples x features) array laid out like the averaged features, or None if any bin has no cells.'''
+    rng = np.random.default_rng(seed)
+    order = np.argsort(group, kind="stable")
+    counts = np.bincount(group, minlength=len(BIN_NAMES))
+    if (counts == 0).any():
+        return None
+
+    values = values[order]
+    tmeans = np.zeros((resamples, len(DST_COLUMNS), len(BIN_NAMES)))
+    start = 0
+    for i in range(0, len(BIN_NAMES)):
+        cells = values[start:start + counts[i]]
+        samples = cells[rng.integers(0, counts[i], size=(resamples, counts[i]))]
+        # (resamples x features) rows of cells, trimmed like trimmed_means
+        samples = np.ascontiguousarray(samples.transpose(0, 2, 1)).reshape(-1, counts[i])
+        tmeans[:, :, i] = trimmed_means(samples).reshape(resamples, len(DST_COLUMNS))
+        start += counts[i]
+    return tmeans.reshape(resamples, -1)
+
+def bootstrap_files(filepaths, resamples, seed=None):
+    '''Resampled truncated means of one or more single-cell features files, pooled like average_files.
+    Outputs a (resamples x features) array, or None if no file could be read or any bin has no cells.'''
+    groups = []
+    values = []
+    for filepath in filepaths:
+        try:
+            features = extract_columns(filepath)
+            group, dst = bin_cells(features, assign_bins(features))
+        except (ValueError, IndexError, OSError):
+            continue
+        groups.append(group)
+        values.append(dst)
+
+    if len(groups) == 0:
+        return None
+    return bootstrap_groups(np.concatenate(groups), np.concatenate(values), resamples, seed)
+
+def _average_files_star(args):
+    '''Unpacks arguments for average_files, for use with Pool.imap. Returns the result with the instrumentation
+    records of the unit (see instrument.call).'''
+    return instrument.call(average_files, args)
+
+def group_files(files, pattern=None):
+    '''Groups file names into units that are averaged together. Without a pattern, each file is its own unit named
+    by the file name up to the first ".". With a regular expression, files are grouped by its first capturing group
+    (e.g. the protein or strain ID); files that do not match are left out.
+    Outputs a sorted list of (name, list of file names).'''
+    if pattern is None:
+        return [(file.split(".")[0], [file]) for file in sorted(files)]
+
+    regex = re.compile(pattern)
+    if regex.groups < 1:
+        raise ValueError("The grouping pattern " + pattern + " has no capturing group")
+    groups = {}
+    for file in sorted(files):
+        match = regex.search(file)
+        if match is None:
+            print ("File skipped: Does not match the grouping pattern ", file)
+            continue
+        groups.setdefault(match.group(1), []).append(file)
+    return sorted(groups.items())
+
+def grouping_pattern(pattern):
+    '''Checks the --group-pattern argument: a valid regular expression with at least one capturing group.'''
     try:
-        # Go through each feature and append the tmean in order
-        for i in range(6, 11):
-            tmean_features.append(stats.trim_mean(np.array(b0[:, i].astype('float')), 0.05))
-            tmean_features.append(stats.trim_mean(np.array(b1[:, i].astype('float')), 0.05))
-            tmean_features.append(stats.trim_mean(np.array(b2[:, i].astype('float')), 0.05))
-            tmean_features.append(stats.trim_mean(np.array(b3[:, i].astype('float')), 0.05))
-            tmean_features.append(stats.trim_mean(np.array(b4[:, i].astype('float')), 0.05))
-            tmean_features.append(stats.trim_mean(np.array(m0[:, i].astype('float')), 0.05))
-            tmean_features.append(stats.trim_mean(np.array(m1[:, i].astype('float')), 0.05))
-            tmean_features.append(stats.trim_mean(np.array(m2[:, i].astype('float')), 0.05))
-            tmean_features.append(stats.trim_mean(np.array(m3[:, i].astype('float')), 0.05))
-            tmean_features.append(stats.trim_mean(np.array(m4[:, i].astype('float')), 0.05))
-    except:
-        # If there are any empty bins (will cause exception), we'll return an empty vector
-        tmean_features = []
-    return tmean_features
+        regex = re.compile(pattern)
+    except re.error as e:
+        raise argparse.ArgumentTypeError("invalid regular expression " + pattern + ": " + str(e))
+    if regex.groups < 1:
+        raise argparse.ArgumentTypeError("the pattern " + pattern + " needs a capturing group, e.g. '^([^_]+)_'")
+    return pattern
 
-if __name__ == '__main__':
+def load_manifest(manifestfile):
+    '''Opens the manifest of an incremental run: a dictionary from each unit (file, or protein when grouping) to the
+    size and modification time of its files, its row name, truncated means and the messages for its skipped files.'''
+    if not os.path.isfile(manifestfile):
+        return {}
+    with open(manifestfile) as f:
+        return json.load(f)
+
+def save_manifest(manifestfile, manifest):
+    '''Writes the manifest of an incremental run, replacing the old manifest only once the new one is complete.'''
+    with open(manifestfile + ".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(manifestfile + ".tmp", manifestfile)
+
+def write_averaged_features(outputfile, rows, float_format=None):
+    '''Writes the truncated means of each image to the output file, given a list of (image name, features).'''
+    names = [file for file, final_features in rows]
+    matrix = np.array([final_features for file, final_features in rows], dtype=np.float64)
+    packageGeneMatrix(outputfile, HEADERS, names, matrix.reshape(len(rows), len(HEADERS) - 1),
+                      float_format=float_format)
+
+def main(argv=None, prog=None):
+    '''Averages a directory of single-cell files from the command line (argv defaults to sys.argv[1:]).'''
     parser = argparse.ArgumentParser(description='Convert a directory of single-cell files into a truncated'
-                                                 'mean summary file for each protein.')
+                                                 'mean summary file for each protein.', prog=prog)
     parser.add_argument("input", help="Input directory containing files", type=str)
     parser.add_argument("output", help="Output to write to.", type=str)
-    args = parser.parse_args()
+    parser.add_argument("--jobs", help="Number of files to process in parallel", type=int, default=1)
+    parser.add_argument("--group-pattern", help="Regular expression matched against the file names; files with the "
+                                                "same first capturing group (e.g. '^([^_]+)_' for the protein ID) "
+                                                "are pooled into one row", type=grouping_pattern, default=None)
+    add_format_argument(parser)
+    parser.add_argument("--incremental", help="Only process files that are new or changed since the last run, "
+                                              "using a manifest stored next to the output", action="store_true")
+    instrument.add_arguments(parser)
+    args = parser.parse_args(argv)
+    instrument.enable_from_args(args)
 
     inputdir = args.input
     if inputdir[-1] != "/":
         inputdir = inputdir + "/"
 
-    # Open the output file
-    output = open(args.output, "w")
-    output.truncate()
-
-    # Write the headers
-    headers = ["ImageName", "SEF_B0", "SEF_B1", "SEF_B2", "SEF_B3", "SEF_B4", "SEF_M0", "SEF_M1",
-               "SEF_M2", "SEF_M3", "SEF_M4", "MCT_B0", "MCT_B1", "MCT_B2", "MCT_B3", "MCT_B4", "MCT_M0",
-               "MCT_M1", "MCT_M2", "MCT_M3", "MCT_M4", "EDG_B0", "EDG_B1", "EDG_B2", "EDG_B3", "EDG_B4",
-               "EDG_M0", "EDG_M1", "EDG_M2", "EDG_M3", "EDG_M4", "CEN_B0", "CEN_B1", "CEN_B2", "CEN_B3",
-               "CEN_B4", "CEN_M0", "CEN_M1", "CEN_M2", "CEN_M3", "CEN_M4", "NEC_B0", "NEC_B1", "NEC_B2",
-               "NEC_B3", "NEC_B4", "NEC_M0", "NEC_M1", "NEC_M2", "NEC_M3", "NEC_M4"]
-    for header in headers[:-1]:
-        output.write(header)
-        output.write("\t")
-    output.write(headers[-1])
-    output.write("\n")
-
-    # Write the features
-    for file in os.listdir(inputdir):
-        filepath = inputdir + file
-        try:
-            features = extract_columns(filepath)
-            bins = assign_bins(features)
-            final_features = tmean_bins(features, bins)
-
-            if final_features == []:
-                print ("File skipped: Not enough valid cells in ", file)
-            else:
-                try:
-                    file = file.split(".")[0]
-                except:
-                    pass
-                output.write(file)
-                output.write("\t")
-                for feature in final_features[:-1]:
-                    output.write(str(feature))
-                    output.write("\t")
-                output.write(str(final_features[-1]))
-                output.write("\n")
-        except:
-            print ("ERROR: Could not process file in directory - skipped ", file)
-    output.close()
+    # Group the files into units to average together (one per file, or one per protein with --group-pattern)
+    # In incremental mode, reuse the results of units whose files' sizes and modification times haven't changed
+    units = group_files(os.listdir(inputdir), args.group_pattern)
+    manifestfile = args.output + ".manifest"
+    manifest = load_manifest(manifestfile) if args.incremental else {}
+    # Units are keyed by their file when not grouping, as several files can share a name
+    keys = [name if args.group_pattern is not None else files[0] for name, files in units]
+    changed = []
+    for key, (name, files) in zip(keys, units):
+        stats = dict((file, [os.stat(inputdir + file).st_size, os.stat(inputdir + file).st_mtime]) for file in files)
+        entry = manifest.get(key)
+        if entry is None or entry.get("files") != stats:
+            manifest[key] = {"files": stats}
+            changed.append((key, name, [inputdir + file for file in files]))
+    if args.incremental:
+        print ("Processing %d new or changed units out of %d." % (len(changed), len(units)))
+
+    # Units are processed in sorted order, and Pool.imap keeps that order, so the output is deterministic
+    # Each unit's cells only need to be held in memory while that unit is being averaged
+    if args.jobs > 1:
+        pool = Pool(args.jobs)
+        results = pool.imap(_average_files_star, [(name, paths) for key, name, paths in changed])
+    else:
+        pool = None
+        results = map(_average_files_star, [(name, paths) for key, name, paths in changed])
 
+    for (key, _, _), (name, final_features, messages) in zip(changed, instrument.merged(results)):
+        manifest[key].update({"name": name, "features": final_features, "messages": messages})
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    rows = []
+    for key in keys:
+        for message in manifest[key]["messages"]:
+            print (message)
+            instrument.skip(key, message)
+        if manifest[key]["features"] != []:
+            rows.append((manifest[key]["name"], manifest[key]["features"]))
+    write_averaged_features(args.output, rows, args.float_format)
+
+    if args.incremental:
+        # Drop units whose files have been removed from the directory
+        save_manifest(manifestfile, dict((key, manifest[key]) for key in keys))
+
+    instrument.write_report()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+'''Calculate protein change profiles for many perturbation screens against the same untreated wild-type screen.
+
+The wild-type screen is read once, and the nearest neighbors of each of its proteins are found once. For each
+perturbation screen, the neighbors are restricted to the proteins shared with the screen: the nearest neighbors within
+the shared proteins are the first cached neighbors that are shared. Only proteins with too few shared cached neighbors
+are searched again. Screens are processed in parallel worker processes.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<https://www.gnu.org/licenses/>.'''
+
+from util import openGeneMatrix
+from util import packageGeneMatrix
+from util import add_format_argument
+from calculate_protein_change_profiles import add_statistics_arguments
+from calculate_protein_change_profiles import brute_neighbors
+from calculate_protein_change_profiles import calculateModZScores
+from calculate_protein_change_profiles import intersect_rows
+from calculate_protein_change_profiles import nearest_neighbors
+from calculate_protein_change_profiles import neighbor_statistics
+from calculate_protein_change_profiles import subtract_matrices
+from multiprocessing import Pool
+import os
+import argparse
+import instrument
+import numpy as np
+
+class ReferenceNeighbors(object):
+    '''Nearest neighbors of every protein in a reference screen, found once and restricted to the proteins shared
+    with each condition.'''
+    def __init__(self, reference, candidates, metric='euclidean', block_size=1024):
+        self.headers, self.genelist, self.genematrix = openGeneMatrix(reference)
+        self.metric = metric
+        self.block_size = block_size
+        self.candidates = min(candidates, self.genematrix.shape[0] - 1)
+        self.nearest = nearest_neighbors(self.candidates, self.genematrix, metric=metric, block_size=block_size)
+
+    def restrict(self, rows, k):
+        '''Finds the k nearest neighbors of each of the given reference rows among the given rows only
+        Inputs: rows of the reference shared with a condition, k
+        Output: (rows x k) matrix of indices into rows of the nearest neighbors, sorted from nearest to furthest'''
+        if k > len(rows) - 1:
+            raise ValueError("k (%d) must be smaller than the number of proteins (%d)" % (k, len(rows)))
+
+        # Map the cached neighbors to positions in rows (-1 if the neighbor is not shared with the condition)
+        position = np.full(self.genematrix.shape[0], -1, dtype=np.int64)
+        position[rows] = np.arange(len(rows))
+        mapped = position[self.nearest[rows]]
+
+        # Keep the first k shared neighbors of each protein, in order of distance
+        shared = mapped >= 0
+        enough = shared.sum(axis=1) >= k
+        keep = shared & (np.cumsum(shared, axis=1) <= k)
+        nearest = np.zeros((len(rows), k), dtype=np.int64)
+        nearest[enough] = mapped[enough][keep[enough]].reshape(-1, k)
+
+        # Search again for the proteins with too few shared cached neighbors
+        missing = np.where(~enough)[0]
+        if len(missing) > 0:
+            nearest[missing] = brute_neighbors(k, self.genematrix[rows[missing]], self.genematrix[rows], missing,
+                                               metric=self.metric, block_size=self.block_size)
+        return nearest
+
+def output_name(condition, outdir):
+    '''Returns the output file of a condition, e.g. ALP3_averaged_features.txt -> (outdir)/ALP3_change.txt'''
+    name = os.path.splitext(os.path.basename(condition))[0]
+    if name.endswith("_averaged_features"):
+        name = name[:-len("_averaged_features")]
+    return os.path.join(outdir, name + "_change.txt")
+
+# Reference neighbors shared with the worker processes
+REFERENCE = None
+
+def _init_worker(reference):
+    '''Stores the reference neighbors in a worker process.'''
+    global REFERENCE
+    REFERENCE = reference
+
+def process_condition(condition, output, k, dtype=np.float64, zero_mad='nan', float_format=None):
+    '''Calculates the protein change profiles of a condition against the reference, and writes them to output.
+    Returns the condition, the number of proteins shared with the reference, and the output file.'''
+    with instrument.stage("batch/condition", conditions=1):
+        return _process_condition(condition, output, k, dtype, zero_mad, float_format)
+
+def _process_condition(condition, output, k, dtype=np.float64, zero_mad='nan', float_format=None):
+    '''Calculates the protein change profiles of one condition (see process_condition).'''
+    cond_headers, cond_genelist, cond_genematrix = openGeneMatrix(condition)
+    intersect, ref_rows, cond_rows = intersect_rows(REFERENCE.genelist, cond_genelist)
+    instrument.count(rows=len(intersect))
+    sorted_ref = REFERENCE.genematrix[ref_rows]
+    sorted_cond = cond_genematrix[cond_rows]
+
+    subtracted = subtract_matrices(sorted_ref, sorted_cond)
+    with instrument.stage("batch/restrict_neighbors"):
+        nearest = REFERENCE.restrict(ref_rows, k)
+    with instrument.stage("change/statistics", rows=len(intersect)):
+        medians, MAD = neighbor_statistics(subtracted, nearest, dtype=dtype, block_size=REFERENCE.block_size,
+                                           zero_mad=zero_mad)
+    zscores = calculateModZScores(subtracted, medians, MAD, dtype=dtype)
+
+    packageGeneMatrix(output, REFERENCE.headers, intersect, zscores, float_format=float_format)
+    return condition, len(intersect), output
+
+def _process_condition_star(args):
+    '''Unpacks arguments for process_condition, for use with Pool.imap. Returns the result with the
+    instrumentation records of the condition (see instrument.call).'''
+    return instrument.call(process_condition, args)
+
+def main(argv=None, prog=None):
+    '''Calculates change profiles for many screens from the command line (argv defaults to sys.argv[1:]).'''
+    parser = argparse.ArgumentParser(description='Create protein localization change profiles for many perturbation '
+                                                 'screens against one untreated wild-type screen.', prog=prog)
+    parser.add_argument("reference", help="Reference untreated wild-type screen", type=str)
+    parser.add_argument("-conditions", nargs='+', help="Perturbation screens", required=True)
+    parser.add_argument("-outdir", help="Directory to write the change profiles to (one per perturbation screen, "
+                                        "named (screen)_change.txt)", type=str, required=True)
+    parser.add_argument("--k", help="k parameter for knn normalization", type=int, default=50)
+    parser.add_argument("--candidates", help="Number of neighbors to find for each reference protein (default 2k); "
+                                             "more candidates mean fewer proteins have to be searched again for "
+                                             "screens missing many proteins", type=int, default=None)
+    parser.add_argument("--jobs", help="Number of screens to process in parallel", type=int, default=1)
+    add_format_argument(parser)
+    add_statistics_arguments(parser)
+    instrument.add_arguments(parser)
+    args = parser.parse_args(argv)
+    instrument.enable_from_args(args)
+
+    if not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+    candidates = args.candidates if args.candidates is not None else 2 * args.k
+
+    print ("Finding nearest neighbors in the reference screen...")
+    with instrument.stage("batch/reference_neighbors"):
+        reference = ReferenceNeighbors(args.reference, candidates, block_size=args.block_size)
+
+    dtype = np.dtype(args.precision).type
+    jobs = [(condition, output_name(condition, args.outdir), args.k, dtype, args.zero_mad, args.float_format)
+            for condition in args.conditions]
+    if args.jobs > 1:
+        pool = Pool(args.jobs, initializer=_init_worker, initargs=(reference,))
+        results = pool.imap(_process_condition_star, jobs)
+    else:
+        pool = None
+        _init_worker(reference)
+        results = map(_process_condition_star, jobs)
+
+    for condition, shared, output in instrument.merged(results):
+        print ("Calculated change profiles for %d proteins in %s" % (shared, condition))
+    if pool is not None:
+        pool.close()
+        pool.join()
+    print ("Done!")
+
+    instrument.write_report()
+
+if __name__ == '__main__':
+    main()
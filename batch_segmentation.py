@@ -1,14 +1,289 @@
 import os
+import time
+import instrument
 import subprocess
 import shlex
+import shutil
+import tempfile
+import hashlib
+import glob
+import socket
 import argparse
+from multiprocessing import Pool
 
-if __name__ == '__main__':
+# Parameters of PMExtractFeatures (see the Budding Yeast Morphologist documentation)
+EXTRACT_ARGS = "-a 0.1 10 0.9 0.1 50"
+
+class StageFailed(Exception):
+    '''Raised when a Morphologist stage of an image fails, so the stages that depend on it are not run.'''
+
+class StageCache(object):
+    '''On-disk content-addressed cache for the outputs of Morphologist stages.
+    Each entry is a directory named by the key of the stage (the hash of its inputs and command line) holding the
+    output files of that stage. Entries are touched when used, and the least recently used ones are evicted once the
+    cache grows past its size limit.'''
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        if self.directory[-1] != "/":
+            self.directory = self.directory + "/"
+        self.max_bytes = max_bytes
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def fetch(self, key, outputs):
+        '''Copies the outputs of a cached stage to the given paths. Returns False if the stage is not cached.'''
+        entry = self.directory + key + "/"
+        try:
+            for i, output in enumerate(outputs):
+                shutil.copy(entry + str(i), output)
+            os.utime(entry, None)
+        except (IOError, OSError):
+            return False
+        return True
+
+    def store(self, key, outputs):
+        '''Adds the outputs of a stage to the cache, then evicts old entries if the cache is too large.'''
+        entry = self.directory + key
+        if os.path.isdir(entry) or not all(os.path.isfile(output) for output in outputs):
+            return
+        tmp = tempfile.mkdtemp(prefix=".tmp_", dir=self.directory) + "/"
+        for i, output in enumerate(outputs):
+            shutil.copy(output, tmp + str(i))
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # Another worker stored the same stage first
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        '''Removes least recently used entries until the cache fits within its size limit.'''
+        entries = []
+        total = 0
+        for key in os.listdir(self.directory):
+            entry = self.directory + key
+            if key.startswith(".tmp_") or not os.path.isdir(entry):
+                continue
+            try:
+                size = sum(os.path.getsize(entry + "/" + f) for f in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), size, entry))
+            except OSError:
+                continue
+            total += size
+        for mtime, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+def run_stage(command, outputs, parents, cache=None, placeholders=()):
+    '''Runs a single Morphologist stage, reusing its outputs from the cache if available.
+    The key of a stage is the hash of the keys of the stages it depends on and of its command line (with the scratch
+    and input paths, given as placeholders, normalized away). Outputs are only cached if the program and the stages it
+    depends on succeeded, and are removed if it failed. Returns the key of the stage, or None if the program failed.'''
+    normalized = command
+    for path, name in placeholders:
+        normalized = normalized.replace(path, name)
+    # Stages that depend on a failed stage (with a key of None) are run, but neither fetched nor stored
+    if None in parents:
+        cache = None
+    key = hashlib.sha256(("\n".join(str(parent) for parent in parents) + "\n" + normalized).encode("utf-8")).hexdigest()
+    program = os.path.basename(shlex.split(command)[0])
+    image = os.path.basename(dict((name, path) for path, name in placeholders).get("<image>", ""))
+
+    start = time.perf_counter()
+    if cache is not None and cache.fetch(key, outputs):
+        instrument.subprocess_run(program, time.perf_counter() - start, None, cached=True, image=image,
+                                  command=normalized)
+        return key
+    returncode = subprocess.call(shlex.split(command))
+    instrument.subprocess_run(program, time.perf_counter() - start, returncode, image=image, command=normalized)
+    if returncode != 0:
+        # A program that crashed or was killed may have left partial outputs, which must not be used or cached
+        print ("ERROR: " + program + " exited with status " + str(returncode))
+        for output in outputs:
+            if os.path.isfile(output):
+                os.remove(output)
+        return None
+    if cache is not None:
+        cache.store(key, outputs)
+    return key
+
+def is_complete(featurefile):
+    '''Checks if a feature file has been completely written by PMExtractFeatures. A complete file is non-empty,
+    starts with the FrameID header and ends with a newline.'''
+    if not os.path.isfile(featurefile) or os.path.getsize(featurefile) == 0:
+        return False
+    with open(featurefile, "rb") as f:
+        first = f.readline()
+        f.seek(-1, os.SEEK_END)
+        last = f.read(1)
+    return first.startswith(b"FrameID") and last == b"\n"
+
+def scratch_prefix(ID):
+    '''Returns the prefix of the scratch directories of an image, which records the process and host using it:
+    .ID_scratch_(pid)@(host).'''
+    return "." + ID + "_scratch_" + str(os.getpid()) + "@" + socket.gethostname() + "."
+
+def is_abandoned(scratch, ID):
+    '''Checks if a scratch directory of an image belongs to a process of this host that is no longer running.
+    Directories of other hosts (or in another format) can't be checked, and are never considered abandoned.'''
+    owner = os.path.basename(scratch.rstrip("/"))[len("." + ID + "_scratch_"):]
+    if "@" not in owner:
+        return False
+    pid, host = owner.split("@", 1)
+    if host.rsplit(".", 1)[0] != socket.gethostname() or not pid.isdigit():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        pass
+    return False
+
+def make_confidence_matrices(PMbin, confmatrices, cache=None):
+    '''Compile quality measures into a confidence matrix binary file
+    These quality measures are based upon manually curated cells, and used to estimate the probability of objects
+    being cells - the file can be found in the Budding Yeast Morphologist repository
+    (https://github.com/lfhandfield/Budding-Yeast-morphologist) under /example/Quality_measures.txt
+    Returns the cache key of the confidence matrices.'''
+    quality = PMbin.rsplit("/", 2)[0] + "/example/Quality_measures.txt"
+    command = PMbin + "PMMakeConfidenceMatrices " + confmatrices + " " + quality
+    qualitykey = ""
+    if cache is not None and os.path.isfile(quality):
+        # util (and numpy) is only imported when caching, so segmentation starts quickly
+        from util import hash_file
+        qualitykey = hash_file(quality)
+    return run_stage(command, [confmatrices], [qualitykey], cache,
+                     [(confmatrices, "<confmatrices>"), (quality, "<quality>")])
+
+def process_image(image, inputdir, PMbin, confmatrices, confkey="", cache=None, extract_args=EXTRACT_ARGS):
+    '''Runs the full segmentation and feature extraction pipeline on a single tif file.
+    All intermediate files are written to a scratch directory private to this image, so that several images can be
+    processed at the same time. The feature and preview files are only moved into the input directory once they
+    have been written completely. If a StageCache is given, stages whose inputs and parameters have not changed
+    since a previous run reuse their cached outputs instead of being run again. extract_args are the parameters
+    given to PMExtractFeatures.
+    Processing stops at the first stage that fails. An error while processing the image (e.g. a missing confidence
+    matrix file) is reported and the image is skipped, so that one bad image does not stop the whole batch.
+    Returns the ID of the image and whether a complete feature file was produced.'''
+    with instrument.stage("segment/image", images=1):
+        try:
+            return _process_image(image, inputdir, PMbin, confmatrices, confkey, cache, extract_args)
+        except StageFailed:
+            # run_stage has already reported the failed program
+            return image.split(".")[0], False
+        except Exception as e:
+            print ("ERROR: Failed to process image " + image + ": " + repr(e))
+            return image.split(".")[0], False
+
+def _process_image(image, inputdir, PMbin, confmatrices, confkey="", cache=None, extract_args=EXTRACT_ARGS):
+    '''Runs the pipeline on a single tif file (see process_image).'''
+    ID = image.split(".")[0]
+    # Remove scratch directories left behind by earlier runs of this image that were killed (but not those of
+    # processes that are still running, e.g. another batch on the same directory)
+    for leftover in glob.glob(inputdir + "." + glob.escape(ID) + "_scratch_*"):
+        if is_abandoned(leftover, ID):
+            shutil.rmtree(leftover, ignore_errors=True)
+    scratch = tempfile.mkdtemp(prefix=scratch_prefix(ID), dir=inputdir) + "/"
+    placeholders = [(scratch + ID, "<scratch>/ID"), (inputdir + image, "<image>")]
+    imagekey = ""
+    if cache is not None:
+        from util import hash_file
+        imagekey = hash_file(inputdir + image)
+
+    def required_stage(command, outputs, parents):
+        '''Runs a stage whose outputs the later stages need, raising StageFailed if it fails.'''
+        key = run_stage(command, outputs, parents, cache, placeholders)
+        if key is None:
+            raise StageFailed(command)
+        return key
+
+    try:
+        # Parse tiff files for red channels
+        command = PMbin + "PMTiffManip -f 2,4,6,8 " + inputdir + image + " " + scratch + ID + "_red.tiff"
+        redkey = required_stage(command, [scratch + ID + "_red.tiff"], [imagekey])
+
+        # Seperate Background and Foreground in Images
+        command = PMbin + "PMSegmentation -B 1.0f -b " + scratch + ID + ".scp -d " + scratch + ID + "_dist.tiff " + \
+                  scratch + ID + "_red.tiff " + scratch + ID + "_seg.tiff"
+        segkey = required_stage(command, [scratch + ID + ".scp", scratch + ID + "_dist.tiff", scratch + ID + "_seg.tiff"],
+                           [redkey])
+
+        # Identify cell centers
+        command = PMbin + "PMFindMultiCover -o " + scratch + ID + "_ellfit.mcv -R2 1.0 6.0 " + \
+                  scratch + ID + "_red.tiff " + scratch + ID + "_seg.tiff " + scratch + ID + "_dist.tiff "
+        ellkey = required_stage(command, [scratch + ID + "_ellfit.mcv"], [redkey, segkey])
+
+        # Find cell sub-segments
+        command = PMbin + "PMWaterShed -M -b 1.0 " + scratch + ID + "_red.tiff " + scratch + ID + "_watershed.tiff"
+        watkey = required_stage(command, [scratch + ID + "_watershed.tiff"], [redkey])
+
+        # Cell identification from circle coordinated directed sub-segment agglomeration
+        command = PMbin + "PMHiddenMapDirect -M -G " + scratch + ID + "_watershed.tiff " + "-C " + \
+                  scratch + ID + "_cellseg.tiff " + scratch + ID + "_seg.tiff " + scratch + ID + \
+                  "_dist.tiff " + scratch + ID + "_ellfit.mcv "
+        cellkey = required_stage(command, [scratch + ID + "_cellseg.tiff"], [watkey, segkey, ellkey])
+
+        # Parse tiff files for "green" channel
+        command = PMbin + "PMTiffManip -f 1,3,5,7 " + inputdir + image + " " + scratch + ID + "_gre.tiff"
+        grekey = required_stage(command, [scratch + ID + "_gre.tiff"], [imagekey])
+
+        # Copy temporary version of confidence measure
+        shutil.copy(confmatrices, scratch + ID + "_conf_matrices.scp")
+
+        # Measure GFP Intensity and spatial spread
+        command = PMbin + "PMExtractFeatures -c " + scratch + ID + "_conf_matrices.scp -m " + \
+                  scratch + ID + "_ellfit.mcv " + extract_args + " -t " + scratch + ID + ".txt -S " + \
+                  scratch + ID + "_seg.tiff " + scratch + ID + "_red.tiff " + \
+                  scratch + ID + "_gre.tiff " + scratch + ID + "_cellseg.tiff"
+        featkey = required_stage(command, [scratch + ID + ".txt"],
+                                 [confkey, ellkey, segkey, redkey, grekey, cellkey])
+
+        # Produce a Displayable RGB Tiff file showing the cell boundary and bud necks (the features are kept even if
+        # this fails):
+        command = PMbin + "PMMakeDisplay " + scratch + ID + ".txt " + scratch + ID + "_cellseg.tiff " \
+                  + scratch + ID + "_red.tiff " + scratch + ID + "_gre.tiff " + scratch + ID + "_preview.tiff "
+        run_stage(command, [scratch + ID + "_preview.tiff"], [featkey, cellkey, redkey, grekey], cache, placeholders)
+
+        # Move the outputs into the input directory (the feature file last, as it marks the image as done)
+        if os.path.isfile(scratch + ID + "_preview.tiff"):
+            os.replace(scratch + ID + "_preview.tiff", inputdir + ID + "_preview.tiff")
+        complete = is_complete(scratch + ID + ".txt")
+        if complete:
+            os.replace(scratch + ID + ".txt", inputdir + ID + ".txt")
+    finally:
+        # Clean up intermediate files
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    return ID, complete
+
+def _process_image_star(args):
+    '''Unpacks arguments for process_image, for use with Pool.imap_unordered. Returns the result with the
+    instrumentation records of the image (see instrument.call).'''
+    return instrument.call(process_image, args)
+
+def main(argv=None, prog=None):
+    '''Runs batch segmentation from the command line (argv defaults to sys.argv[1:]).'''
     parser = argparse.ArgumentParser(description='Run batch segmentation and feature extraction on a directory of '
-                                                 'tif files of yeast microscopy images.')
+                                                 'tif files of yeast microscopy images.', prog=prog)
     parser.add_argument("directory", help="Input directory containing tif files", type=str)
     parser.add_argument("bin", help="Location of Budding Yeast Morphologist Programs.", type=str)
-    args = parser.parse_args()
+    parser.add_argument("--workers", help="Number of images to process in parallel", type=int, default=1)
+    parser.add_argument("--no-resume", help="Reprocess images that already have a complete feature file",
+                        action="store_true")
+    parser.add_argument("--cache", help="Directory to cache the outputs of each stage in, so reruns only execute "
+                                        "stages whose inputs or parameters changed", type=str, default=None)
+    parser.add_argument("--cache-size", help="Maximum size of the stage cache in GB (least recently used "
+                                             "entries are evicted first)", type=float, default=50.0)
+    parser.add_argument("--extract-args", help="Parameters of PMExtractFeatures (default '%(default)s'); with "
+                                               "--cache, only feature extraction is rerun when they change. Use "
+                                               "--no-resume to rerun images that already have a feature file",
+                        type=str, default=EXTRACT_ARGS)
+    instrument.add_arguments(parser)
+    args = parser.parse_args(argv)
+    instrument.enable_from_args(args)
 
     # Standardize the extensions of the paths
     inputdir = args.directory
@@ -19,79 +294,43 @@ if __name__ == '__main__':
     if PMbin[-1] != "/":
         PMbin = PMbin + "/"
 
-    # Compile quality measures into a confidence matrix binary file
-    # These quality measures are based upon manually curated cells, and used to estimate the probability of objects
-    # being cells - the file can be found in the Budding Yeast Morphologist repository
-    # (https://github.com/lfhandfield/Budding-Yeast-morphologist) under /example/Quality_measures.txt
-    command = PMbin + "PMMakeConfidenceMatrices ./Conf_Matrices.scp " + \
-              PMbin.rsplit("/", 2)[0] + "/example/Quality_measures.txt"
-    subprocess.call(shlex.split(command))
+    cache = None
+    if args.cache is not None:
+        cache = StageCache(args.cache, int(args.cache_size * 1024 ** 3))
+
+    confmatrices = os.path.abspath("./Conf_Matrices.scp")
+    with instrument.stage("segment/confidence_matrices"):
+        confkey = make_confidence_matrices(PMbin, confmatrices, cache)
 
-    images = os.listdir(inputdir)
-    for image in images:
+    # Skip images that already have a complete feature file, so interrupted runs pick up where they stopped
+    images = []
+    for image in sorted(os.listdir(inputdir)):
         if image.endswith(".tif"):
-            ID = image.split(".")[0]
-
-            # Parse tiff files for red channels
-            command = PMbin + "PMTiffManip -f 2,4,6,8 " + inputdir + image + " " + inputdir + ID + "_red.tiff"
-            subprocess.call(shlex.split(command))
-
-            # Seperate Background and Foreground in Images
-            command = PMbin + "PMSegmentation -B 1.0f -b " + inputdir + ID + ".scp -d " + inputdir + ID + "_dist.tiff " + \
-                      inputdir + ID + "_red.tiff " + inputdir + ID + "_seg.tiff"
-            subprocess.call(shlex.split(command))
-
-            # Identify cell centers
-            command = PMbin + "PMFindMultiCover -o " + inputdir + ID + "_ellfit.mcv -R2 1.0 6.0 " + \
-                      inputdir + ID + "_red.tiff " + inputdir + ID + "_seg.tiff " + inputdir + ID + "_dist.tiff "
-            subprocess.call(shlex.split(command))
-
-            # Find cell sub-segments
-            command = PMbin + "PMWaterShed -M -b 1.0 " + inputdir + ID + "_red.tiff " + inputdir + ID + "_watershed.tiff"
-            subprocess.call(shlex.split(command))
-
-            # Cell identification from circle coordinated directed sub-segment agglomeration
-            command = PMbin + "PMHiddenMapDirect -M -G " + inputdir + ID + "_watershed.tiff " + "-C " +\
-                      inputdir + ID + "_cellseg.tiff " + inputdir + ID + "_seg.tiff " + inputdir + ID + \
-                      "_dist.tiff " + inputdir + ID + "_ellfit.mcv "
-            subprocess.call(shlex.split(command))
-
-            # Parse tiff files for "green" channel
-            command = PMbin + "PMTiffManip -f 1,3,5,7 " + inputdir + image + " " + inputdir + ID + "_gre.tiff"
-            subprocess.call(shlex.split(command))
-
-            # Copy temporary version of confidence measure
-            command = "cp ./Conf_Matrices.scp " + inputdir + ID + "_conf_matrices.scp"
-            subprocess.call(shlex.split(command))
-
-            # Measure GFP Intensity and spatial spread
-            command = PMbin + "PMExtractFeatures -c " + inputdir + ID + "_conf_matrices.scp -m " + \
-                      inputdir + ID + "_ellfit.mcv -a 0.1 10 0.9 0.1 50 -t " + inputdir + ID + ".txt -S " + \
-                      inputdir + ID + "_seg.tiff " + inputdir + ID + "_red.tiff " +\
-                      inputdir + ID + "_gre.tiff " + inputdir + ID + "_cellseg.tiff"
-            subprocess.call(shlex.split(command))
-
-            # Produce a Displayable RGB Tiff file showing the cell boundary and bud necks:
-            command = PMbin + "PMMakeDisplay " + inputdir + ID + ".txt " + inputdir + ID + "_cellseg.tiff " \
-                      + inputdir + ID + "_red.tiff " + inputdir + ID + "_gre.tiff " + inputdir + ID + "_preview.tiff "
-            subprocess.call(shlex.split(command))
-
-            # Clean up intermediate files
-            command = "rm " + inputdir + ID + "_red.tiff"
-            subprocess.call(shlex.split(command))
-            command = "rm " + inputdir + ID + "_gre.tiff"
-            subprocess.call(shlex.split(command))
-            command = "rm " + inputdir + ID + "_dist.tiff"
-            subprocess.call(shlex.split(command))
-            command = "rm " + inputdir + ID + ".scp"
-            subprocess.call(shlex.split(command))
-            command = "rm " + inputdir + ID + "_watershed.tiff"
-            subprocess.call(shlex.split(command))
-            command = "rm " + inputdir + ID + "_conf_matrices.scp"
-            subprocess.call(shlex.split(command))
-            command = "rm " + inputdir + ID + "_ellfit.mcv"
-            subprocess.call(shlex.split(command))
-            command = "rm " + inputdir + ID + "_cellseg.tiff"
-            subprocess.call(shlex.split(command))
-            command = "rm " + inputdir + ID + "_seg.tiff"
-            subprocess.call(shlex.split(command))
+            if not args.no_resume and is_complete(inputdir + image.split(".")[0] + ".txt"):
+                print ("Skipping already processed image ", image)
+                instrument.skip(image, "already processed")
+            else:
+                images.append(image)
+
+    jobs = [(image, inputdir, PMbin, confmatrices, confkey, cache, args.extract_args) for image in images]
+    if args.workers > 1:
+        pool = Pool(args.workers)
+        results = pool.imap_unordered(_process_image_star, jobs)
+    else:
+        pool = None
+        results = map(_process_image_star, jobs)
+
+    for count, (ID, complete) in enumerate(instrument.merged(results)):
+        if not complete:
+            print ("ERROR: No complete feature file produced for ", ID)
+            instrument.skip(ID, "no complete feature file produced")
+        print ("Processed %d out of %d images." % ((count + 1), len(jobs)))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    instrument.write_report()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,319 @@
+'''Benchmark the stages of the pipeline on synthetic data of increasing size.
+
+Synthetic inputs are generated from the files in examples/: single-cell feature files in the Morphologist format are
+made of rows drawn from examples/example_single_cell_features.txt, with new cell IDs and mother-bud pairs, and averaged
+feature matrices are drawn from the per-feature means and standard deviations of examples/WT2_averaged_features.txt.
+Perturbation screens are the wild-type screen plus noise, with some proteins missing and the rest shuffled.
+
+Each stage is timed over several repeats (the fastest and median times are reported), then run once more under
+tracemalloc to measure its peak memory. Results are written as JSON, and two result files (e.g. from two commits) can be
+compared with the compare mode.
+
+The calibrate mode checks that the p-values of bootstrap_change_profiles.py are uniform on synthetic data with no real
+change, and fails if they are anti-conservative or conservative.
+
+Example:
+    python benchmark.py run -output before.json
+    (change the code)
+    python benchmark.py run -output after.json
+    python benchmark.py compare before.json after.json
+    python benchmark.py calibrate
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<https://www.gnu.org/licenses/>.'''
+
+import util
+from util import openGeneMatrix
+from util import packageGeneMatrix
+from average_single_cells import assign_bins
+from average_single_cells import extract_columns
+from average_single_cells import tmean_bins
+from calculate_protein_change_profiles import calculateModZScores
+from calculate_protein_change_profiles import filter_matrices
+from calculate_protein_change_profiles import modWeights
+from calculate_protein_change_profiles import subtract_matrices
+from concatenate_profiles import sort_proteins
+from bootstrap_change_profiles import null_pvalues
+from bootstrap_change_profiles import expected_fraction
+import os
+import sys
+import csv
+import json
+import time
+import shutil
+import argparse
+import platform
+import contextlib
+import tempfile
+import tracemalloc
+import subprocess
+import numpy as np
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples")
+STAGES = ["extract_columns", "tmean_bins", "filter_matrices", "modWeights", "calculateModZScores", "sort_proteins",
+          "openGeneMatrix", "openGeneMatrix_cached", "packageGeneMatrix", "packageGeneMatrix_binary"]
+
+def generate_single_cell_file(path, cells, rng):
+    '''Writes a Morphologist feature file with the given number of cells, made of rows drawn from the example file
+    About 60% of the cells are mother-bud pairs (as in the example); the other cells are unpaired.'''
+    with open(os.path.join(EXAMPLES, "example_single_cell_features.txt")) as f:
+        rows = list(csv.reader(f, delimiter='\t'))
+    headers, rows = rows[0], rows[1:]
+    frame, cell_id, cell_type, rel_cell_id = [headers.index(name) for name in
+                                              ["FrameID", "CellID", "Cell_type", "Rel_Cell_ID"]]
+    mothers = [row for row in rows if row[cell_type] == "m"]
+    buds = [row for row in rows if row[cell_type] == "b"]
+    others = [row for row in rows if row[cell_type] not in ("m", "b")]
+
+    pairs = int(cells * len(mothers) / float(len(rows)))
+    output = []
+    for i in range(0, pairs):
+        mother = list(mothers[rng.integers(len(mothers))])
+        bud = list(buds[rng.integers(len(buds))])
+        mother[rel_cell_id], bud[rel_cell_id] = str(2 * i + 2), str(2 * i + 1)
+        output += [mother, bud]
+    for i in range(0, cells - 2 * pairs):
+        other = list(others[rng.integers(len(others))])
+        other[rel_cell_id] = "-1"
+        output.append(other)
+    for i, row in enumerate(output):
+        row[frame], row[cell_id] = "0", str(i + 1)
+
+    with open(path, "w") as f:
+        f.write("\t".join(headers) + "\n")
+        f.write("".join("\t".join(row) + "\n" for row in output))
+
+def generate_averaged_matrix(path, proteins, rng):
+    '''Writes an averaged features file for the given number of proteins, with features drawn from the per-feature
+    means and standard deviations of the example wild-type screen. Returns the protein names.'''
+    headers, genelist, genematrix = openGeneMatrix(os.path.join(EXAMPLES, "WT2_averaged_features.txt"), cache=False)
+    genematrix = np.asarray(genematrix, dtype=np.float64)
+    names = np.array(["P%06d" % i for i in range(0, proteins)])
+    matrix = rng.normal(genematrix.mean(axis=0), genematrix.std(axis=0), size=(proteins, genematrix.shape[1]))
+    packageGeneMatrix(path, headers, names, matrix)
+    return names
+
+def generate_condition(path, reference, rng, missing=0.05, noise=0.5):
+    '''Writes a perturbation screen: the reference screen plus noise (scaled by each feature's standard deviation),
+    with a fraction of the proteins missing and the other proteins in a random order'''
+    headers, genelist, genematrix = openGeneMatrix(reference, cache=False)
+    genematrix = np.asarray(genematrix, dtype=np.float64)
+    keep = rng.permutation(len(genelist))[:int(round(len(genelist) * (1 - missing)))]
+    matrix = genematrix[keep] + rng.normal(0, noise, size=(len(keep), genematrix.shape[1])) * genematrix.std(axis=0)
+    packageGeneMatrix(path, headers, genelist[keep], matrix)
+
+def generate_profiles(path, proteins, rng, missing=0.05):
+    '''Writes a change profile file like the output of calculate_protein_change_profiles.py, with z-scores for a
+    random subset of the proteins'''
+    headers, _, _ = openGeneMatrix(os.path.join(EXAMPLES, "WT2_averaged_features.txt"), cache=False)
+    keep = np.sort(rng.permutation(len(proteins))[:int(round(len(proteins) * (1 - missing)))])
+    packageGeneMatrix(path, headers, proteins[keep], rng.normal(0, 1, size=(len(keep), len(headers) - 1)))
+
+@contextlib.contextmanager
+def quiet():
+    '''Discards the progress messages printed by the stages'''
+    with open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stdout(devnull):
+            yield
+
+def measure(function, repeat):
+    '''Runs a function repeat times and once more under tracemalloc
+    Output: dictionary of the fastest and median times in seconds, all times, and the peak memory in bytes'''
+    times = []
+    with quiet():
+        for i in range(0, repeat):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {"seconds": min(times), "median_seconds": float(np.median(times)), "times": times, "peak_bytes": peak}
+
+def benchmark(workdir, stages, cells, proteins, conditions, k=50, repeat=3, seed=0):
+    '''Generates synthetic inputs in workdir and benchmarks the given stages for each size
+    Output: list of results, one dictionary per stage and size'''
+    rng = np.random.default_rng(seed)
+    results = []
+
+    def record(stage, params, function):
+        if stage not in stages:
+            return
+        result = measure(function, repeat)
+        result.update({"stage": stage, "params": params})
+        results.append(result)
+        print ("%-26s %-40s %10.4f s %10.1f MB" % (stage, json.dumps(params), result["seconds"],
+                                                    result["peak_bytes"] / 1024.0 ** 2))
+
+    # Text gene matrices are parsed every time unless a stage is about the binary cache
+    util.CACHE_GENE_MATRICES = False
+
+    for n in cells:
+        path = os.path.join(workdir, "cells_%d.txt" % n)
+        with quiet():
+            generate_single_cell_file(path, n, rng)
+        record("extract_columns", {"cells": n}, lambda: extract_columns(path))
+        features = extract_columns(path)
+        record("tmean_bins", {"cells": n}, lambda: tmean_bins(features, assign_bins(features)))
+
+    for n in proteins:
+        reference = os.path.join(workdir, "reference_%d.txt" % n)
+        condition = os.path.join(workdir, "condition_%d.txt" % n)
+        with quiet():
+            names = generate_averaged_matrix(reference, n, rng)
+            generate_condition(condition, reference, rng)
+
+        record("filter_matrices", {"proteins": n}, lambda: filter_matrices(reference, condition))
+        genelist, sorted_ref, sorted_cond = filter_matrices(reference, condition)
+        subtracted = subtract_matrices(sorted_ref, sorted_cond)
+        record("modWeights", {"proteins": n, "k": k}, lambda: modWeights(k, subtracted, sorted_ref))
+        with quiet():
+            medians, MAD = modWeights(k, subtracted, sorted_ref)
+        record("calculateModZScores", {"proteins": n}, lambda: calculateModZScores(subtracted, medians, MAD))
+
+        headers, genelist, genematrix = openGeneMatrix(reference)
+        text = os.path.join(workdir, "write_%d.txt" % n)
+        binary = os.path.join(workdir, "write_%d.npy" % n)
+        record("openGeneMatrix", {"proteins": n}, lambda: openGeneMatrix(reference))
+        with quiet():
+            openGeneMatrix(reference, cache=True)
+        record("openGeneMatrix_cached", {"proteins": n}, lambda: openGeneMatrix(reference, cache=True))
+        record("packageGeneMatrix", {"proteins": n}, lambda: packageGeneMatrix(text, headers, genelist, genematrix))
+        record("packageGeneMatrix_binary", {"proteins": n},
+               lambda: packageGeneMatrix(binary, headers, genelist, genematrix))
+
+        reference_list = os.path.join(workdir, "proteins_%d.txt" % n)
+        with open(reference_list, "w") as f:
+            f.write("".join(name + "\n" for name in names))
+        for m in conditions:
+            screens = [os.path.join(workdir, "screen%d_%d.txt" % (i, n)) for i in range(0, m)]
+            for screen in screens:
+                if not os.path.isfile(screen):
+                    with quiet():
+                        generate_profiles(screen, names, rng)
+            record("sort_proteins", {"proteins": n, "conditions": m},
+                   lambda: sort_proteins(screens, reference_list))
+    return results
+
+def environment():
+    '''Describes the code and machine the benchmark ran on'''
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit": commit, "python": platform.python_version(), "numpy": np.__version__,
+            "platform": platform.platform(), "processor": platform.processor(), "cpus": os.cpu_count(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+def compare(baseline, current, threshold=1.1):
+    '''Compares two result files, matching results by stage and parameters
+    Output: list of (stage, parameters, baseline seconds, current seconds, ratio), and whether any stage got slower
+    than threshold times its baseline time'''
+    with open(baseline) as f:
+        before = dict((result["stage"] + json.dumps(result["params"], sort_keys=True), result)
+                      for result in json.load(f)["results"])
+    with open(current) as f:
+        after = json.load(f)["results"]
+
+    rows = []
+    regressed = False
+    for result in after:
+        key = result["stage"] + json.dumps(result["params"], sort_keys=True)
+        if key not in before:
+            continue
+        ratio = result["seconds"] / before[key]["seconds"]
+        regressed = regressed or ratio > threshold
+        rows.append((result["stage"], result["params"], before[key]["seconds"], result["seconds"], ratio))
+    return rows, regressed
+
+def calibrate(proteins=2000, k=50, seed=0, levels=(0.01, 0.05, 0.1, 0.5), tolerance=1.25):
+    '''Calculates p-values on synthetic data with no real change (see bootstrap_change_profiles.null_pvalues)
+    Output: list of (level, fraction of p-values at most the level, expected fraction for calibrated p-values), and
+    whether at any level the fraction was more than tolerance times the level (anti-conservative p-values) or less
+    than the expected fraction divided by tolerance (conservative p-values)'''
+    pvalues = null_pvalues(proteins, k=k, seed=seed)
+    rows = [(level, float((pvalues <= level).mean()), float(expected_fraction(level, k))) for level in levels]
+    return rows, any(fraction > tolerance * level or fraction < expected / tolerance
+                     for level, fraction, expected in rows)
+
+def parse_sizes(sizes):
+    '''Parses a comma-separated list of sizes'''
+    return [int(size) for size in sizes.split(",") if size != ""]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages on synthetic data, or compare two '
+                                                 'benchmark results.')
+    parser.add_argument("mode", help="run: run the benchmarks; compare: compare two result files; calibrate: check "
+                                     "the bootstrap p-values on data with no real change",
+                        choices=["run", "compare", "calibrate"])
+    parser.add_argument("results", nargs="*", help="In compare mode, the baseline and current result files")
+    parser.add_argument("-output", help="File to write the results to (run mode)", type=str, default=None)
+    parser.add_argument("--stages", help="Comma-separated list of stages to benchmark (default all): " +
+                        ", ".join(STAGES), type=str, default=",".join(STAGES))
+    parser.add_argument("--cells", help="Comma-separated numbers of cells per single-cell file", type=str,
+                        default="500,2000,8000")
+    parser.add_argument("--proteins", help="Comma-separated numbers of proteins per screen", type=str,
+                        default="1000,4000")
+    parser.add_argument("--conditions", help="Comma-separated numbers of screens to concatenate", type=str,
+                        default="2,8")
+    parser.add_argument("--k", help="k parameter for knn normalization", type=int, default=50)
+    parser.add_argument("--repeat", help="Number of timed runs of each stage", type=int, default=3)
+    parser.add_argument("--seed", help="Random seed of the synthetic data", type=int, default=0)
+    parser.add_argument("--workdir", help="Directory to generate the synthetic data in (default a temporary "
+                                          "directory, removed afterwards)", type=str, default=None)
+    parser.add_argument("--threshold", help="In compare mode, report a regression when a stage is slower than this "
+                                            "many times its baseline time", type=float, default=1.1)
+    args = parser.parse_args()
+
+    if args.mode == "compare":
+        if len(args.results) != 2:
+            parser.error("compare mode needs a baseline and a current result file")
+        rows, regressed = compare(args.results[0], args.results[1], args.threshold)
+        for stage, params, before, after, ratio in rows:
+            flag = "  SLOWER" if ratio > args.threshold else ""
+            print ("%-26s %-40s %10.4f s -> %10.4f s  x%.2f%s" % (stage, json.dumps(params), before, after, ratio,
+                                                                  flag))
+        sys.exit(1 if regressed else 0)
+
+    if args.mode == "calibrate":
+        rows, miscalibrated = calibrate(parse_sizes(args.proteins)[-1], args.k, seed=args.seed)
+        for level, fraction, expected in rows:
+            print ("p-values <= %-5g %8.4f (expected %.4f)" % (level, fraction, expected))
+        if miscalibrated:
+            print ("ERROR: p-values are not calibrated on data with no real change")
+        sys.exit(1 if miscalibrated else 0)
+
+    if args.output is None:
+        parser.error("-output is required in run mode")
+    stages = args.stages.split(",")
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if len(unknown) > 0:
+        parser.error("unknown stages: " + ", ".join(unknown))
+
+    workdir = args.workdir if args.workdir is not None else tempfile.mkdtemp(prefix="benchmark")
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    try:
+        results = benchmark(workdir, stages, parse_sizes(args.cells), parse_sizes(args.proteins),
+                            parse_sizes(args.conditions), args.k, args.repeat, args.seed)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump({"environment": environment(), "results": results}, f, indent=1)
+    print ("Written to file " + args.output)
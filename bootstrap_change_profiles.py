@@ -0,0 +1,305 @@
+'''Estimate the significance of protein change profiles by resampling the nearest neighbors of each protein.
+
+For each protein, its k nearest neighbors in the wild-type screen are resampled with replacement B times. Each resample
+gives a median and MAD, and so a z-score for the protein; the percentiles of these z-scores are a bootstrap confidence
+interval. The empirical p-value of a protein compares its z-score with those of its neighbors, which did not change:
+each neighbor is scored against the median and MAD of the other k - 1 neighbors and the protein itself, so that like
+the protein it is scored against k values, and the p-value is the fraction of the k + 1 z-scores (the protein's
+included) at least as extreme as the protein's. On data with no real change this is an exact rank test, so the
+p-values are uniform over the multiples of 1 / (k + 1), the smallest possible p-value (see null_pvalues).
+
+Optionally, the single cells behind each (cell type, bin) of the protein in both screens are also resampled, so the
+confidence intervals include the uncertainty of the truncated means themselves.
+
+All B resamples of a block of proteins are computed at once, blocks are spread over worker processes, and every
+protein draws from its own random stream seeded by (seed, protein), so results don't depend on the number of workers.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<https://www.gnu.org/licenses/>.'''
+
+from util import openGeneMatrix
+from util import packageGeneMatrix
+from util import add_format_argument
+from average_single_cells import bootstrap_files
+from average_single_cells import group_files
+from calculate_protein_change_profiles import add_statistics_arguments
+from calculate_protein_change_profiles import block_statistics
+from calculate_protein_change_profiles import calculateModZScores
+from calculate_protein_change_profiles import filter_matrices
+from calculate_protein_change_profiles import nearest_neighbors
+from calculate_protein_change_profiles import neighbor_statistics
+from calculate_protein_change_profiles import subtract_matrices
+from multiprocessing import Pool
+import os
+import argparse
+import instrument
+import warnings
+import numpy as np
+
+# Number of values in the (proteins x resamples x k x features) array of resampled neighbors of a block of proteins,
+# which bounds the memory used by each worker (8M values are 64 MB in float64)
+BLOCK_VALUES = 1 << 23
+
+def sorted_median(values, axis):
+    '''Median along an axis of values that are already sorted along it, calculated like np.median'''
+    half = values.shape[axis] // 2
+    if values.shape[axis] % 2 == 1:
+        return np.take(values, half, axis=axis)
+    return np.take(values, [half - 1, half], axis=axis).mean(axis=axis)
+
+def resample_statistics(neighbors, indices, dtype=np.float64, zero_mad='nan'):
+    '''Calculates the median and MAD of resampled neighbors, for all resamples of a block of proteins at once
+    Sorting the few neighbors of each resample and taking the middle is faster than np.median, and gives the same
+    results.
+    Inputs: (proteins x k x features) changes of the neighbors of each protein, (proteins x resamples x k) indices of
+    the resampled neighbors, output dtype, zero MAD handling (see neighbor_statistics)
+    Output: (proteins x resamples x features) medians and MADs'''
+    samples = np.sort(neighbors[np.arange(neighbors.shape[0])[:, None, None], indices], axis=2)
+    medians = sorted_median(samples, axis=2).astype(dtype)
+    deviations = np.sort(np.abs(medians[:, :, None, :] - samples.astype(dtype)), axis=2)
+    MAD = sorted_median(deviations, axis=2)
+    if zero_mad == 'meanad':
+        zero = MAD == 0
+        MAD[zero] = (0.6745 * 1.253314 * deviations.mean(axis=2, dtype=dtype))[zero]
+    return medians, MAD
+
+def leave_one_out_pvalues(changes, neighbors, observed, dtype=np.float64, zero_mad='nan'):
+    '''Empirical p-values of a block of proteins against the z-scores of their neighbors
+    The protein and its k neighbors are pooled, and each of them is scored against the median and MAD of the other k,
+    the same way the observed z-score of the protein is calculated from its k neighbors.
+    Inputs: (proteins x features) changes, (proteins x k x features) changes of their neighbors, observed z-scores,
+    output dtype, zero MAD handling (see neighbor_statistics)
+    Output: (proteins x features) p-values'''
+    k = neighbors.shape[1]
+    pool = np.concatenate((changes[:, None, :], neighbors), axis=1)
+    others = np.array([[i for i in range(0, k + 1) if i != j] for j in range(0, k + 1)])
+    medians, MAD = resample_statistics(pool, np.broadcast_to(others, (pool.shape[0], k + 1, k)), dtype=dtype,
+                                       zero_mad=zero_mad)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = dtype(0.6745) * (pool.astype(dtype) - medians) / MAD
+    scores[MAD == 0] = np.nan
+
+    # The first score is the protein's own, against its k neighbors; neighbors with an undefined z-score are left out
+    null = scores[:, 1:]
+    valid = ~np.isnan(null)
+    extreme = (np.abs(null) >= np.abs(scores[:, :1])) & valid
+    pvalues = (1 + extreme.sum(axis=1)) / (1 + valid.sum(axis=1)).astype(dtype)
+    pvalues[np.isnan(observed) | np.isnan(scores[:, 0])] = np.nan
+    return pvalues
+
+def bootstrap_block(changes, neighbors, observed, resamples, seeds, alpha=0.05, dtype=np.float64, zero_mad='nan',
+                    cell_changes=None):
+    '''Bootstraps the z-scores of a block of proteins
+    Inputs: (proteins x features) changes, (proteins x k x features) changes of their neighbors, observed z-scores,
+    number of resamples, one random seed per protein, confidence level alpha, output dtype, zero MAD handling,
+    optional (proteins x resamples x features) changes calculated from resampled single cells
+    Output: empirical p-values (see leave_one_out_pvalues), and lower and upper bounds of the (1 - alpha) confidence
+    intervals'''
+    k = neighbors.shape[1]
+    rngs = [np.random.default_rng(seed) for seed in seeds]
+    indices = np.stack([rng.integers(0, k, size=(resamples, k)) for rng in rngs])
+    medians, MAD = resample_statistics(neighbors, indices, dtype=dtype, zero_mad=zero_mad)
+
+    if cell_changes is None:
+        cell_changes = changes[:, None, :]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        zscores = dtype(0.6745) * (cell_changes.astype(dtype) - medians) / MAD
+    zscores[MAD == 0] = np.nan
+    pvalues = leave_one_out_pvalues(changes, neighbors, observed, dtype=dtype, zero_mad=zero_mad)
+
+    # Resamples with an undefined z-score are left out of the confidence intervals
+    percentiles = [100 * alpha / 2, 100 * (1 - alpha / 2)]
+    if np.isnan(zscores).any():
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            lower, upper = np.nanpercentile(zscores, percentiles, axis=1)
+    else:
+        lower, upper = np.percentile(zscores, percentiles, axis=1)
+    return pvalues, lower.astype(dtype), upper.astype(dtype)
+
+def null_pvalues(proteins=2000, features=10, k=50, seed=0):
+    '''Calculates p-values on synthetic data with no real change, to check that they are calibrated: the changes of
+    all proteins are drawn from the same normal distribution, and the neighbors of each protein are k other proteins
+    drawn at random, so the p-values should be uniform over the multiples of 1 / (k + 1) (e.g. a fraction 2 / 51 of
+    them at most 0.05 for k = 50, see expected_fraction)
+    Inputs: number of proteins, features, k, random seed
+    Output: (proteins x features) p-values'''
+    rng = np.random.default_rng(seed)
+    changes = rng.normal(size=(proteins, features))
+    # Offsets 1 to proteins - 1 from each protein, so a protein is never its own neighbor
+    nearest = (np.arange(proteins)[:, None] + 1 + np.stack([rng.choice(proteins - 1, size=k, replace=False)
+                                                            for row in range(0, proteins)])) % proteins
+    medians, MAD = block_statistics(changes[nearest], [k])
+    observed = calculateModZScores(changes, medians[0], MAD[0], warn=False)
+
+    pvalues = np.zeros(observed.shape)
+    block = max(1, BLOCK_VALUES // ((k + 1) * k * features))
+    for start in range(0, proteins, block):
+        end = min(start + block, proteins)
+        pvalues[start:end] = leave_one_out_pvalues(changes[start:end], changes[nearest[start:end]],
+                                                   observed[start:end])
+    return pvalues
+
+def expected_fraction(level, k):
+    '''Fraction of calibrated p-values at most a level, for p-values that are multiples of 1 / (k + 1)'''
+    return np.floor(level * (k + 1) + 1e-9) / (k + 1)
+
+# Inputs shared with the worker processes
+SHARED = None
+
+def _init_worker(shared):
+    '''Stores the inputs shared by all blocks in a worker process.'''
+    global SHARED
+    SHARED = shared
+
+def process_block(start, end):
+    '''Bootstraps the z-scores of proteins start to end, using the shared inputs.
+    Returns start, end, and the p-values and confidence intervals of the block.'''
+    with instrument.stage("bootstrap/block", rows=end - start):
+        return _process_block(start, end)
+
+def _process_block(start, end):
+    '''Bootstraps the z-scores of one block of proteins (see process_block).'''
+    subtracted = SHARED["subtracted"]
+    rows = np.arange(start, end)
+    seeds = [[SHARED["seed"], row, 0] for row in rows]
+
+    cell_changes = None
+    if SHARED["cells"] is not None:
+        # Proteins without single cells in both screens keep their averaged change in every resample
+        cell_changes = np.repeat(subtracted[start:end, None, :].astype(np.float64), SHARED["resamples"], axis=1)
+        for i, row in enumerate(rows):
+            ref_files, cond_files = SHARED["cells"][row]
+            if len(ref_files) == 0 or len(cond_files) == 0:
+                continue
+            ref = bootstrap_files(ref_files, SHARED["resamples"], [SHARED["seed"], row, 1])
+            cond = bootstrap_files(cond_files, SHARED["resamples"], [SHARED["seed"], row, 2])
+            if ref is not None and cond is not None:
+                cell_changes[i] = ref - cond
+
+    pvalues, lower, upper = bootstrap_block(subtracted[start:end], subtracted[SHARED["nearest"][start:end]],
+                                            SHARED["observed"][start:end], SHARED["resamples"], seeds,
+                                            alpha=SHARED["alpha"], dtype=SHARED["dtype"],
+                                            zero_mad=SHARED["zero_mad"], cell_changes=cell_changes)
+    return start, end, pvalues, lower, upper
+
+def _process_block_star(args):
+    '''Unpacks arguments for process_block, for use with Pool.imap. Returns the result with the instrumentation
+    records of the block (see instrument.call).'''
+    return instrument.call(process_block, args)
+
+def single_cell_files(genelist, cellsdir, pattern=None):
+    '''Finds the single-cell feature files behind each row of an averaged features file, the same way
+    average_single_cells.py names its rows (see group_files)
+    Output: list of the paths of the files of each gene (empty if none are found)'''
+    units = dict(group_files(os.listdir(cellsdir), pattern))
+    return [[os.path.join(cellsdir, file) for file in units.get(gene, [])] for gene in genelist]
+
+def output_name(output, statistic):
+    '''Returns the output file for a statistic, e.g. ALP3_change.txt -> ALP3_change_pvalues.txt'''
+    root, extension = os.path.splitext(output)
+    return root + "_" + statistic + extension
+
+def main(argv=None, prog=None):
+    '''Bootstraps the change profiles of a pair of screens from the command line (argv defaults to sys.argv[1:]).'''
+    parser = argparse.ArgumentParser(description='Calculate protein localization change profiles for a pair of '
+                                                 'files, with bootstrap confidence intervals and empirical p-values '
+                                                 'for each feature in each protein.', prog=prog)
+    parser.add_argument("reference", help="Reference untreated wild-type screen", type=str)
+    parser.add_argument("condition", help="Perturbation screen", type=str)
+    parser.add_argument("output", help="Output to write the z-scores to; p-values and confidence intervals are "
+                                       "written next to it (output_pvalues.txt, output_lower.txt and "
+                                       "output_upper.txt)", type=str)
+    parser.add_argument("--k", help="k parameter for knn normalization", type=int, default=50)
+    parser.add_argument("--resamples", help="Number of bootstrap resamples", type=int, default=1000)
+    parser.add_argument("--seed", help="Random seed (results are reproducible for the same seed)", type=int,
+                        default=0)
+    parser.add_argument("--alpha", help="Confidence intervals cover 1 - alpha of the bootstrap z-scores", type=float,
+                        default=0.05)
+    parser.add_argument("--jobs", help="Number of worker processes", type=int, default=1)
+    parser.add_argument("--cells-reference", help="Directory of the single-cell feature files of the reference "
+                                                  "screen, to also resample the cells behind each bin", type=str,
+                        default=None)
+    parser.add_argument("--cells-condition", help="Directory of the single-cell feature files of the perturbation "
+                                                  "screen", type=str, default=None)
+    parser.add_argument("--group-pattern", help="Grouping pattern the averaged features were made with (see "
+                                                "average_single_cells.py)", type=str, default=None)
+    add_format_argument(parser)
+    add_statistics_arguments(parser)
+    instrument.add_arguments(parser)
+    args = parser.parse_args(argv)
+    instrument.enable_from_args(args)
+    if args.k < 2:
+        parser.error("--k must be at least 2, so that the neighbors have a MAD")
+    if (args.cells_reference is None) != (args.cells_condition is None):
+        parser.error("--cells-reference and --cells-condition must be given together")
+
+    print ("Calculating protein localization change profiles...")
+    genelist, sorted_ref, sorted_cond = filter_matrices(args.reference, args.condition)
+    subtracted = subtract_matrices(sorted_ref, sorted_cond)
+    dtype = np.dtype(args.precision).type
+    headers, _, _ = openGeneMatrix(args.reference)
+
+    with instrument.stage("change/neighbors", rows=len(genelist)):
+        nearest = nearest_neighbors(args.k, sorted_ref, block_size=args.block_size)
+    with instrument.stage("change/statistics", rows=len(genelist)):
+        medians, MAD = neighbor_statistics(subtracted, nearest, dtype=dtype, block_size=args.block_size,
+                                           zero_mad=args.zero_mad)
+    observed = calculateModZScores(subtracted, medians, MAD, dtype=dtype)
+    packageGeneMatrix(args.output, headers, genelist, observed, float_format=args.float_format)
+
+    cells = None
+    if args.cells_reference is not None:
+        cells = list(zip(single_cell_files(genelist, args.cells_reference, args.group_pattern),
+                         single_cell_files(genelist, args.cells_condition, args.group_pattern)))
+        found = sum(1 for ref_files, cond_files in cells if len(ref_files) > 0 and len(cond_files) > 0)
+        print ("Found single cells in both screens for %d out of %d proteins." % (found, len(cells)))
+
+    shared = {"subtracted": subtracted, "nearest": nearest, "observed": observed, "resamples": args.resamples,
+              "seed": args.seed, "alpha": args.alpha, "dtype": dtype, "zero_mad": args.zero_mad, "cells": cells}
+    # Each block holds the resampled neighbors, and the k + 1 leave-one-out sets of neighbors for the p-values
+    proteins = max(1, BLOCK_VALUES // (max(args.resamples, args.k + 1) * args.k * subtracted.shape[1]))
+    blocks = [(start, min(start + proteins, len(genelist))) for start in range(0, len(genelist), proteins)]
+    if args.jobs > 1:
+        pool = Pool(args.jobs, initializer=_init_worker, initargs=(shared,))
+        results = pool.imap_unordered(_process_block_star, blocks)
+    else:
+        pool = None
+        _init_worker(shared)
+        results = map(_process_block_star, blocks)
+
+    pvalues = np.zeros(observed.shape, dtype=dtype)
+    lower = np.zeros(observed.shape, dtype=dtype)
+    upper = np.zeros(observed.shape, dtype=dtype)
+    done = 0
+    for start, end, block_pvalues, block_lower, block_upper in instrument.merged(results):
+        pvalues[start:end] = block_pvalues
+        lower[start:end] = block_lower
+        upper[start:end] = block_upper
+        done += end - start
+        if done % 500 < end - start or done == len(genelist):
+            print ("Bootstrapped %d out of %d genes." % (done, len(genelist)))
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    print ("Done!")
+    packageGeneMatrix(output_name(args.output, "pvalues"), headers, genelist, pvalues, float_format=args.float_format)
+    packageGeneMatrix(output_name(args.output, "lower"), headers, genelist, lower, float_format=args.float_format)
+    packageGeneMatrix(output_name(args.output, "upper"), headers, genelist, upper, float_format=args.float_format)
+
+    instrument.write_report()
+
+if __name__ == '__main__':
+    main()
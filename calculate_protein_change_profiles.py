@@ -21,96 +21,361 @@ along with this program.  If not, see
 
 from util import openGeneMatrix
 from util import packageGeneMatrix
+from util import indexGeneList
+from util import lookupGenes
+from util import add_format_argument
+import os
+import shutil
 import argparse
+import tempfile
+import instrument
 import numpy as np
-import sklearn.metrics.pairwise as skdist
 
-def filter_matrices (reference, condition):
+# sklearn takes about a second to import, so it is only imported by the functions that use it
+
+# Space-partitioning trees only beat brute force search for low-dimensional data
+TREE_MAX_DIMENSIONS = 16
+
+# Maximum number of gathered neighbor values (proteins x k x features) held in memory at a time out of core
+OUT_OF_CORE_BLOCK_VALUES = 1 << 25
+
+def filter_matrices (reference, condition, report_duplicates=False):
     '''Preprocessing operation - calculates the intersection of proteins between the reference and the
     condition, and sorts them so that they're in the same order.'''
     ref_headers, ref_genelist, ref_genematrix = openGeneMatrix(reference)
     cond_headers, cond_genelist, cond_genematrix = openGeneMatrix(condition)
 
-    sorted_ref = []
-    sorted_cond = []
+    intersect, ref_rows, cond_rows = intersect_rows(ref_genelist, cond_genelist, report_duplicates)
+    sorted_ref = ref_genematrix[ref_rows]
+    sorted_cond = cond_genematrix[cond_rows]
+
+    return intersect, sorted_ref, sorted_cond
+
+def intersect_rows (ref_genelist, cond_genelist, report_duplicates=False):
+    '''Calculates the intersection of proteins between the reference and the condition, and the rows of each
+    protein in the reference and the condition.'''
     # Get the intersection of the list
     # Sometimes there can be duplicate proteins, so we'll just take the first occurrence if there is
     intersect = np.intersect1d(ref_genelist, cond_genelist)
-    for protein in intersect:
-        ref_index = np.where(ref_genelist == protein)[0][0]
-        cond_index = np.where(cond_genelist == protein)[0][0]
-        sorted_ref.append(ref_genematrix[ref_index])
-        sorted_cond.append(cond_genematrix[cond_index])
+    ref_index, ref_duplicates = indexGeneList(ref_genelist)
+    cond_index, cond_duplicates = indexGeneList(cond_genelist)
+    if report_duplicates:
+        if len(ref_duplicates) > 0:
+            print ("Duplicate proteins in the reference (using first occurrence): " + ", ".join(ref_duplicates))
+        if len(cond_duplicates) > 0:
+            print ("Duplicate proteins in the condition (using first occurrence): " + ", ".join(cond_duplicates))
 
-    sorted_ref = np.array(sorted_ref)
-    sorted_cond = np.array(sorted_cond)
+    return intersect, lookupGenes(ref_index, intersect), lookupGenes(cond_index, intersect)
 
-    return intersect, sorted_ref, sorted_cond
+def filter_matrices_to_disk (reference, condition, directory, report_duplicates=False, block_size=1024):
+    '''Preprocessing operation like filter_matrices, for matrices too large to be held in memory: the sorted reference
+    and the subtracted matrix are written to memory-mapped .npy files in a directory, block_size proteins at a time
+    (binary gene matrices, see util.openBinaryGeneMatrix, are read without loading them into memory)
+    Inputs: paths of the reference and the condition, directory, whether to report duplicates, block size
+    Output: feature labels of the reference, intersection of the proteins, memory-mapped sorted reference and
+    subtracted matrices'''
+    ref_headers, ref_genelist, ref_genematrix = openGeneMatrix(reference, mmap=True)
+    cond_headers, cond_genelist, cond_genematrix = openGeneMatrix(condition, mmap=True)
+
+    intersect, ref_rows, cond_rows = intersect_rows(ref_genelist, cond_genelist, report_duplicates)
+    # Keep the precision of the inputs, so results are the same as in memory
+    dtype = np.result_type(ref_genematrix.dtype, cond_genematrix.dtype)
+    shape = (len(intersect), ref_genematrix.shape[1])
+    sorted_ref = np.lib.format.open_memmap(os.path.join(directory, "reference.npy"), mode='w+', dtype=dtype,
+                                           shape=shape)
+    subtracted = np.lib.format.open_memmap(os.path.join(directory, "subtracted.npy"), mode='w+', dtype=dtype,
+                                           shape=shape)
+    for start in range(0, len(intersect), block_size):
+        end = min(start + block_size, len(intersect))
+        sorted_ref[start:end] = ref_genematrix[ref_rows[start:end]]
+        subtracted[start:end] = subtract_matrices(sorted_ref[start:end], cond_genematrix[cond_rows[start:end]])
+    sorted_ref.flush()
+    subtracted.flush()
+    return ref_headers, intersect, sorted_ref, subtracted
 
 def subtract_matrices (sorted_ref, sorted_cond):
     '''Produce a subtracted matrix given two sorted matrices'''
     return np.subtract(sorted_ref, sorted_cond)
 
-def modWeights(k, geneMatrix, distMatrix, metric='euclidean'):
-    '''Generates a mean and MAD vector for each protein in a protein feature matrix using the k closest genes using euclidean distance
-    Inputs: k, wild-type protein feature matrix, change matrix
-    Output: mean and MAD of k NN of proteins'''
-    # Specify distance metric and get nearest neighbors
-    dist = skdist.pairwise_distances(distMatrix, metric=metric)
-    nearest = np.argsort(dist, axis=1)[:, 1:(k + 1)]
-
-    # Calculate mean for each protein
-    means = np.zeros(geneMatrix.shape)
-    for gene in range(0, nearest.shape[0]):
-        for index in nearest[gene]:
-            for feature in range(0, len(geneMatrix[index])):
-                means[gene][feature] += geneMatrix[index][feature]
-        means[gene] = means[gene] / k
-        if ((gene + 1) % 200 == 0 or (gene + 1) == geneMatrix.shape[0]):
-            print ("Calculated means for %d out of %d genes." % ((gene + 1), geneMatrix.shape[0]))
-
-    # Calculate medians and MAD for each protein
-    medians = np.zeros(geneMatrix.shape)
-    MAD = np.zeros(geneMatrix.shape)
-    for gene in range(0, nearest.shape[0]):
-        neighbors = []
-        for index in nearest[gene]:
-            neighbors.append(geneMatrix[index])
-
-        neighbors = np.array(neighbors)
-        for feature in range(0, len(neighbors[0])):
-            medians[gene][feature] = np.median(neighbors[:, feature])
-            MAD[gene][feature] = np.median(abs(medians[gene][feature] - neighbors[:, feature]))
-        if ((gene + 1) % 200 == 0 or (gene + 1) == geneMatrix.shape[0]):
-            print ("Calculated medians for %d out of %d genes." % ((gene + 1), geneMatrix.shape[0]))
+def nearest_neighbors(k, distMatrix, metric='euclidean', block_size=1024, algorithm='auto'):
+    '''Finds the k nearest neighbors of each protein, excluding the protein itself
+    Uses a KD-tree or ball tree for low-dimensional data, and otherwise computes distances for block_size proteins at a
+    time (so memory is bounded by block_size x proteins) and selects the neighbors with argpartition
+    Inputs: k, matrix to calculate distances on, distance metric, block size, algorithm ('auto', 'tree' or 'brute')
+    Output: (proteins x k) matrix of indices of the nearest neighbors, sorted from nearest to furthest'''
+    n = distMatrix.shape[0]
+    if k > n - 1:
+        raise ValueError("k (%d) must be smaller than the number of proteins (%d)" % (k, n))
+
+    from sklearn.neighbors import BallTree
+    from sklearn.neighbors import KDTree
+    if algorithm == 'auto':
+        tree_metric = metric in KDTree.valid_metrics or metric in BallTree.valid_metrics
+        algorithm = 'tree' if tree_metric and distMatrix.shape[1] <= TREE_MAX_DIMENSIONS else 'brute'
+
+    if algorithm == 'tree':
+        tree = KDTree(distMatrix, metric=metric) if metric in KDTree.valid_metrics \
+            else BallTree(distMatrix, metric=metric)
+        nearest = tree.query(distMatrix, k=k + 1, return_distance=False)
+
+        # Remove the protein itself - if it was tied with other proteins and not returned, drop the furthest neighbor
+        is_self = nearest == np.arange(n)[:, None]
+        is_self[~is_self.any(axis=1), -1] = True
+        return nearest[~is_self].reshape(n, k)
+
+    return brute_neighbors(k, distMatrix, distMatrix, np.arange(n), metric=metric, block_size=block_size)
+
+def brute_neighbors(k, queries, points, self_rows, metric='euclidean', block_size=1024):
+    '''Finds the k nearest points to each query by computing distances for block_size queries at a time
+    Inputs: k, query matrix, point matrix, row of each query in the point matrix (excluded from its neighbors),
+    distance metric, block size
+    Output: (queries x k) matrix of indices of the nearest points, sorted from nearest to furthest'''
+    import sklearn.metrics.pairwise as skdist
+    nearest = np.zeros((queries.shape[0], k), dtype=np.int64)
+    for start in range(0, queries.shape[0], block_size):
+        end = min(start + block_size, queries.shape[0])
+        dist = skdist.pairwise_distances(queries[start:end], points, metric=metric)
+        dist[np.arange(end - start), self_rows[start:end]] = np.inf
+
+        # Select the k nearest without sorting the whole row, then sort only those k
+        candidates = np.argpartition(dist, k - 1, axis=1)[:, :k]
+        order = np.argsort(np.take_along_axis(dist, candidates, axis=1), axis=1, kind='stable')
+        nearest[start:end] = np.take_along_axis(candidates, order, axis=1)
+    return nearest
+
+def neighbor_statistics(geneMatrix, nearest, dtype=np.float64, block_size=1024, zero_mad='nan', ks=None):
+    '''Calculates the median and MAD of the neighbors of each protein, block_size proteins at a time
+    The neighbors of each block are gathered into a (proteins x k x features) array, so memory is bounded by
+    block_size x k x features. If zero_mad is 'meanad', MADs of zero are replaced by the scaled mean absolute
+    deviation of the neighbors (Iglewicz and Hoaglin 1993), so that the modified z-score stays defined.
+    If a list of ks is given, the statistics are calculated for the first k neighbors of each protein for each k
+    (the neighbors must be sorted from nearest to furthest), reusing the same gathered neighbors.
+    Inputs: gene matrix, (proteins x k) matrix of neighbor indices, output dtype, block size, zero MAD handling,
+    optional list of ks
+    Output: median and MAD of k NN of proteins (lists of medians and MADs for each k if ks is given)'''
+    sweep = ks is not None
+    if not sweep:
+        ks = [nearest.shape[1]]
+    shape = (nearest.shape[0], geneMatrix.shape[1])
+    medians = [np.zeros(shape, dtype=dtype) for k in ks]
+    MAD = [np.zeros(shape, dtype=dtype) for k in ks]
+    for start in range(0, nearest.shape[0], block_size):
+        end = min(start + block_size, nearest.shape[0])
+        block_medians, block_MAD = block_statistics(geneMatrix[nearest[start:end, :max(ks)]], ks, dtype, zero_mad)
+        for i in range(0, len(ks)):
+            medians[i][start:end] = block_medians[i]
+            MAD[i][start:end] = block_MAD[i]
+        print ("Calculated medians for %d out of %d genes." % (end, nearest.shape[0]))
+
+    if sweep:
+        return medians, MAD
+    return medians[0], MAD[0]
+
+def block_statistics(gathered, ks, dtype=np.float64, zero_mad='nan'):
+    '''Calculates the median and MAD of the first k neighbors of a block of proteins for each k (see
+    neighbor_statistics)
+    Inputs: (proteins x k x features) array of the neighbors of each protein, list of ks, output dtype, zero MAD
+    handling
+    Output: lists of the medians and MADs of the block, one for each k'''
+    medians = []
+    MAD = []
+    for k in ks:
+        neighbors = gathered[:, :k]
 
+        # The median is taken in the precision of the gene matrix, the deviations from it in the output precision
+        median = np.median(neighbors, axis=1).astype(dtype)
+        deviations = np.abs(median[:, None, :] - neighbors.astype(dtype))
+        mad = np.median(deviations, axis=1).astype(dtype)
+        if zero_mad == 'meanad':
+            zero = mad == 0
+            # 1.253314 * MeanAD approximates the standard deviation like 1.4826 * MAD = MAD / 0.6745 does
+            mad[zero] = (0.6745 * 1.253314 * deviations.mean(axis=1, dtype=dtype))[zero]
+        medians.append(median)
+        MAD.append(mad)
     return medians, MAD
 
-def calculateModZScores(geneMatrix, means, MAD):
-    '''Calculates modified z-score vectors for each gene given mean and variance vectors of kNN neighbors
-    Inputs: gene matrix and corresponding mean and variances of kNN neighbors
+def modWeights(k, geneMatrix, distMatrix, metric='euclidean', block_size=1024, dtype=np.float64, zero_mad='nan'):
+    '''Generates a median and MAD vector for each protein in a protein feature matrix using the k closest genes using euclidean distance
+    Inputs: k, change matrix, wild-type protein feature matrix, distance metric, block size, output dtype,
+    zero MAD handling (see neighbor_statistics)
+    Output: median and MAD of k NN of proteins'''
+    # Specify distance metric and get nearest neighbors
+    with instrument.stage("change/neighbors", rows=distMatrix.shape[0]):
+        nearest = nearest_neighbors(k, distMatrix, metric=metric, block_size=block_size)
+    with instrument.stage("change/statistics", rows=geneMatrix.shape[0]):
+        return neighbor_statistics(geneMatrix, nearest, dtype=dtype, block_size=block_size, zero_mad=zero_mad)
+
+def modWeightsSweep(ks, geneMatrix, distMatrix, metric='euclidean', block_size=1024, dtype=np.float64,
+                    zero_mad='nan'):
+    '''Generates median and MAD vectors like modWeights for several values of k in one pass
+    The neighbors are found once for the largest k, and the statistics for each smaller k are calculated from the
+    nearest k of them
+    Inputs: list of ks, change matrix, wild-type protein feature matrix, and the other parameters of modWeights
+    Output: lists of medians and MADs, one for each k'''
+    with instrument.stage("change/neighbors", rows=distMatrix.shape[0]):
+        nearest = nearest_neighbors(max(ks), distMatrix, metric=metric, block_size=block_size)
+    with instrument.stage("change/statistics", rows=geneMatrix.shape[0]):
+        return neighbor_statistics(geneMatrix, nearest, dtype=dtype, block_size=block_size, zero_mad=zero_mad,
+                                   ks=ks)
+
+def calculateModZScores(geneMatrix, means, MAD, dtype=np.float64, warn=True):
+    '''Calculates modified z-score vectors for each gene given median and MAD vectors of kNN neighbors
+    Z-scores of features with a MAD of zero are undefined, and set to NaN
+    Inputs: gene matrix and corresponding median and MAD of kNN neighbors, output dtype, whether to warn about MADs
+    of zero
     Output: zscores'''
-    zscores = np.zeros(geneMatrix.shape)
-    for gene in range(0, geneMatrix.shape[0]):
-        for feature in range(0, len(geneMatrix[gene])):
-            zscores[gene][feature] = 0.6745 * (geneMatrix[gene][feature] - means[gene][feature]) / (MAD[gene][feature])
+    zero = MAD == 0
+    if warn and zero.any():
+        print ("Warning: %d features had a MAD of zero, their z-scores are set to NaN." % zero.sum())
+    with np.errstate(divide='ignore', invalid='ignore'):
+        zscores = (dtype(0.6745) * (geneMatrix.astype(dtype) - means) / MAD).astype(dtype)
+    zscores[zero] = np.nan
     return zscores
 
-if __name__ == '__main__':
+def modZScoresOutOfCore(ks, geneMatrix, distMatrix, directory, metric='euclidean', block_size=1024,
+                        dtype=np.float64, zero_mad='nan'):
+    '''Calculates modified z-scores like modWeightsSweep and calculateModZScores, without holding the medians, MADs or
+    z-scores of all proteins in memory: the statistics and z-scores are calculated for a block of proteins at a time,
+    and the z-scores written to a memory-mapped .npy file in a directory. The block is small enough that its gathered
+    neighbors fit in OUT_OF_CORE_BLOCK_VALUES values, and distances are calculated for block_size proteins at a time.
+    Inputs: list of ks, change matrix, wild-type protein feature matrix (may be memory-mapped, see
+    filter_matrices_to_disk), directory, and the other parameters of modWeights
+    Output: memory-mapped (proteins x (ks x features)) z-scores, with the features of each k in turn'''
+    n, features = geneMatrix.shape
+    with instrument.stage("change/neighbors", rows=n):
+        nearest = nearest_neighbors(max(ks), distMatrix, metric=metric, block_size=block_size)
+
+    zscores = np.lib.format.open_memmap(os.path.join(directory, "zscores.npy"), mode='w+', dtype=dtype,
+                                        shape=(n, len(ks) * features))
+    rows = max(1, min(block_size, OUT_OF_CORE_BLOCK_VALUES // (max(ks) * features)))
+    zero = 0
+    for start in range(0, n, rows):
+        end = min(start + rows, n)
+        with instrument.stage("change/statistics", rows=end - start):
+            medians, MAD = block_statistics(geneMatrix[nearest[start:end]], ks, dtype, zero_mad)
+        with instrument.stage("change/zscores", rows=(end - start) * len(ks)):
+            for i in range(0, len(ks)):
+                zscores[start:end, i * features:(i + 1) * features] = \
+                    calculateModZScores(geneMatrix[start:end], medians[i], MAD[i], dtype=dtype, warn=False)
+                zero += (MAD[i] == 0).sum()
+        print ("Calculated z-scores for %d out of %d genes." % (end, n))
+    if zero > 0:
+        print ("Warning: %d features had a MAD of zero, their z-scores are set to NaN." % zero)
+    zscores.flush()
+    return zscores
+
+def sweep_output_name(output, k):
+    '''Returns the output file for one k of a sweep, e.g. ALP3_change.txt -> ALP3_change_k50.txt'''
+    root, extension = os.path.splitext(output)
+    return root + "_k" + str(k) + extension
+
+def write_zscores(args, ks, headers, genelist, zscores, stacked=None):
+    '''Writes the z-scores for each k to the output file (or files, see sweep_output_name) given on the command line
+    Inputs: parsed arguments, list of ks, feature labels, gene labels, list of z-scores for each k, optional z-scores
+    of all ks already stacked side by side'''
+    if len(ks) == 1:
+        packageGeneMatrix(args.output, headers, genelist, zscores[0], float_format=args.float_format)
+    elif args.stack:
+        stacked_headers = [headers[0]] + ["k" + str(k) + "_" + header for k in ks for header in headers[1:]]
+        if stacked is None:
+            stacked = np.hstack(zscores)
+        packageGeneMatrix(args.output, stacked_headers, genelist, stacked, float_format=args.float_format)
+    else:
+        for k, zscore in zip(ks, zscores):
+            packageGeneMatrix(sweep_output_name(args.output, k), headers, genelist, zscore,
+                              float_format=args.float_format)
+
+def add_statistics_arguments(parser):
+    '''Adds the --block-size, --precision and --zero-mad options of the neighbor statistics and z-scores (see
+    modWeights and calculateModZScores) to the argument parser of a script'''
+    parser.add_argument("--block-size", help="Number of proteins to calculate distances for at a time in the "
+                                             "nearest neighbor search (bounds memory use)", type=int, default=1024)
+    parser.add_argument("--precision", help="Floating point precision of the neighbor statistics and z-scores",
+                        choices=["float32", "float64"], default="float64")
+    parser.add_argument("--zero-mad", help="How to handle features whose neighbors have a MAD of zero: set the "
+                                           "z-score to NaN, or fall back to the mean absolute deviation",
+                        choices=["nan", "meanad"], default="nan")
+
+def main(argv=None, prog=None):
+    '''Calculates change profiles for a pair of screens from the command line (argv defaults to sys.argv[1:]).'''
     parser = argparse.ArgumentParser(description='Create protein localization change profiles for a pair of files.'
-                                                 'Calculates z-scores for each feature in each protein.')
+                                                 'Calculates z-scores for each feature in each protein.', prog=prog)
     parser.add_argument("reference", help="Reference untreated wild-type screen", type=str)
     parser.add_argument("condition", help="Perturbation screen", type=str)
     parser.add_argument("output", help="Output to write to.", type=str)
-    parser.add_argument("--k", help="k parameter for knn normalization", type=int, default=50)
-    args = parser.parse_args()
+    parser.add_argument("--k", help="k parameter for knn normalization, or a comma-separated list of values to "
+                                    "sweep over in one pass (e.g. 10,25,50,100)", type=str, default="50")
+    parser.add_argument("--stack", help="When sweeping over k, write all z-scores to one output file with the "
+                                        "features prefixed by k, instead of one output file per k",
+                        action="store_true")
+    parser.add_argument("--report-duplicates", help="Report proteins that occur more than once in a screen",
+                        action="store_true")
+    add_format_argument(parser)
+    add_statistics_arguments(parser)
+    parser.add_argument("--out-of-core", help="Process proteins a block at a time against memory-mapped copies of "
+                                              "the screens in a scratch directory created in this directory, for "
+                                              "screens with many features (e.g. concatenated profiles)", type=str,
+                        default=None)
+    instrument.add_arguments(parser)
+    args = parser.parse_args(argv)
+    instrument.enable_from_args(args)
+
+    try:
+        ks = sorted(set(int(k) for k in args.k.split(",")))
+    except ValueError:
+        parser.error("--k must be an integer or a comma-separated list of integers")
+    if ks[0] < 1:
+        parser.error("--k must be at least 1")
+
+    def check_proteins(proteins):
+        '''Checks that there are more proteins shared by the screens than the largest k'''
+        if ks[-1] >= proteins:
+            parser.error("--k (%d) must be smaller than the number of proteins shared by the screens (%d)" %
+                         (ks[-1], proteins))
 
     print ("Calculating protein localization change profiles...")
-    genelist, sorted_ref, sorted_cond = filter_matrices(args.reference, args.condition)
-    subtracted = subtract_matrices(sorted_ref, sorted_cond)
-    means, variances = modWeights(args.k, subtracted, sorted_ref)
-    zscores = calculateModZScores(subtracted, means, variances)
+    dtype = np.dtype(args.precision).type
+    if args.out_of_core is not None:
+        if not os.path.isdir(args.out_of_core):
+            os.makedirs(args.out_of_core)
+        scratch = tempfile.mkdtemp(prefix="change_", dir=args.out_of_core)
+        try:
+            with instrument.stage("change/filter"):
+                headers, genelist, sorted_ref, subtracted = filter_matrices_to_disk(args.reference, args.condition,
+                                                                                    scratch, args.report_duplicates,
+                                                                                    args.block_size)
+            check_proteins(len(genelist))
+            stacked = modZScoresOutOfCore(ks, subtracted, sorted_ref, scratch, block_size=args.block_size,
+                                          dtype=dtype, zero_mad=args.zero_mad)
+            features = subtracted.shape[1]
+            zscores = [stacked[:, i * features:(i + 1) * features] for i in range(0, len(ks))]
+            print ("Done!")
+            write_zscores(args, ks, headers, genelist, zscores, stacked)
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+        instrument.write_report()
+        return
 
-    print ("Done!")
+    with instrument.stage("change/filter"):
+        genelist, sorted_ref, sorted_cond = filter_matrices(args.reference, args.condition, args.report_duplicates)
+        subtracted = subtract_matrices(sorted_ref, sorted_cond)
+    check_proteins(len(genelist))
     headers, _, _ = openGeneMatrix(args.reference)
-    packageGeneMatrix(args.output, headers, genelist, zscores)
\ No newline at end of file
+
+    if len(ks) == 1:
+        medians, MAD = modWeights(ks[0], subtracted, sorted_ref, block_size=args.block_size, dtype=dtype,
+                                  zero_mad=args.zero_mad)
+        with instrument.stage("change/zscores", rows=len(genelist)):
+            zscores = [calculateModZScores(subtracted, medians, MAD, dtype=dtype)]
+    else:
+        medians, MAD = modWeightsSweep(ks, subtracted, sorted_ref, block_size=args.block_size, dtype=dtype,
+                                       zero_mad=args.zero_mad)
+        with instrument.stage("change/zscores", rows=len(genelist) * len(ks)):
+            zscores = [calculateModZScores(subtracted, medians[i], MAD[i], dtype=dtype) for i in range(0, len(ks))]
+
+    print ("Done!")
+    write_zscores(args, ks, headers, genelist, zscores)
+    instrument.write_report()
+
+if __name__ == '__main__':
+    main()
@@ -22,59 +22,113 @@ along with this program.  If not, see
 
 from util import openGeneMatrix
 from util import packageGeneMatrix
+from util import indexGeneList
+from util import lookupGenes
+from util import BINARY_EXTENSION
+from util import add_format_argument
+from concurrent.futures import ThreadPoolExecutor
+import instrument
 import numpy as np
 import argparse
-
-def sort_proteins (screen_list, reference_list):
+import csv
+import gzip
+import json
+
+def read_headers (screen):
+    '''Reads only the header line of a screen, to find its features without parsing the whole file.'''
+    if screen.endswith(BINARY_EXTENSION):
+        with open(screen + ".json") as f:
+            return json.load(f)["headers"]
+    if screen.endswith(".gz"):
+        file = gzip.open(screen, "rt")
+    else:
+        file = open(screen)
+    with file:
+        return next(csv.reader(file, delimiter='\t'))
+
+def fill_sorted (block, genelist, genematrix, reference, report_duplicates=False, screen_name=""):
+    '''Sorts the rows of a screen by the list of all proteins into a preallocated block of the output matrix
+    (create a NAN vector if the protein isn't in the screen).'''
+    genelist = np.array([x.strip(' ') for x in genelist])
+
+    # Sort the screen by the reference list (if a protein occurs more than once, the first occurrence wins)
+    index, duplicates = indexGeneList(genelist)
+    if report_duplicates and len(duplicates) > 0:
+        print ("Duplicate proteins in " + screen_name + " (using first occurrence): " + ", ".join(duplicates))
+    rows = lookupGenes(index, reference)
+    found = rows >= 0
+
+    # Proteins missing from the screen get a NAN vector
+    block[~found] = np.nan
+    block[found] = genematrix[rows[found]]
+
+def sort_proteins (screen_list, reference_list, report_duplicates=False, memmap=None, threads=1, dtype=np.float64):
     '''Given a list of screens and a list of all proteins analyzed in all screens, sort all screens by
     the list of all proteins (create a NAN vector if the protein isn't in a screen), and then concatencate
-    the features of the screens together.'''
+    the features of the screens together.
+    The headers of all screens are read first to size the output matrix, which is preallocated (on disk as a
+    np.memmap if a path is given) and filled one block of columns per screen. Screens are loaded by a pool of
+    threads.'''
 
     # Open and read the reference list
     with open(reference_list, 'r') as f:
         reference = [line.rstrip('\n') for line in f]
 
+    # Get a concatencated list of all feature names, and the columns of each screen
     all_headers = ["PROTEIN"]
-    all_matrix = []
-
-    # Iterate through all screens
+    columns = []
     for screen in screen_list:
-        currmatrix = []
-        headers, genelist, genematrix = openGeneMatrix(screen)
-        genelist = np.array([x.strip(' ') for x in genelist])
+        headers = read_headers(screen)
 
         # Automatically get the screen name (to prefix features with for identification)
         screen_name = screen.split("/")[-1].split(".")[0]
-
-        # Sort the screen by the reference list
-        for protein in reference:
-            index = np.where(genelist == protein)[0]
-            if len(index) == 0:
-                vector = np.empty((len(headers[:-1])))
-                vector[:] = np.nan
-                currmatrix.append(vector)
-            else:
-                currmatrix.append(genematrix[index][0])
-
-        # Get a concatencated list of all feature names
+        columns.append((screen, screen_name, len(all_headers) - 1, len(all_headers) - 1 + len(headers[1:])))
         for header in headers[1:]:
             all_headers.append(screen_name + "_" + header)
 
-        # Append the sorted matrices together
-        currmatrix = np.array(currmatrix)
-        if all_matrix == []:
-            all_matrix = currmatrix
-        else:
-            all_matrix = np.hstack((all_matrix, currmatrix))
+    shape = (len(reference), len(all_headers) - 1)
+    if memmap is not None:
+        all_matrix = np.memmap(memmap, dtype=dtype, mode='w+', shape=shape)
+    else:
+        all_matrix = np.empty(shape, dtype=dtype)
+
+    def fill_screen (column):
+        '''Sorts a screen by the reference list into its block of columns of the output matrix.'''
+        screen, screen_name, start, end = column
+        headers, genelist, genematrix = openGeneMatrix(screen, mmap=memmap is not None)
+        fill_sorted(all_matrix[:, start:end], genelist, genematrix, reference, report_duplicates, screen_name)
+
+    # Each screen writes to its own block of columns, so the screens can be filled concurrently
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        list(executor.map(fill_screen, columns))
+    if memmap is not None:
+        all_matrix.flush()
 
     return all_matrix, all_headers, reference
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
+def main(argv=None, prog=None):
+    '''Concatenates change profiles from the command line (argv defaults to sys.argv[1:]).'''
+    parser = argparse.ArgumentParser(prog=prog)
     parser.add_argument('-files', nargs='+', help="List of files to concatencate", required=True)
     parser.add_argument("-output", help="Output to write to.", type=str, required=True)
     parser.add_argument("-reference", help="Location of list containing all genes in screens.", type=str, required=True)
-    args = parser.parse_args()
+    parser.add_argument("--report-duplicates", help="Report proteins that occur more than once in a screen",
+                        action="store_true")
+    parser.add_argument("--memmap", help="Build the concatenated matrix in this file on disk instead of in memory",
+                        type=str, default=None)
+    add_format_argument(parser)
+    parser.add_argument("--threads", help="Number of screens to load concurrently", type=int, default=1)
+    instrument.add_arguments(parser)
+    args = parser.parse_args(argv)
+    instrument.enable_from_args(args)
+
+    with instrument.stage("concatenate/sort", screens=len(args.files)):
+        all_matrix, all_headers, reference = sort_proteins(args.files, args.reference, args.report_duplicates,
+                                                           memmap=args.memmap, threads=args.threads)
+        instrument.count(rows=len(reference))
+    packageGeneMatrix(args.output, all_headers, reference, all_matrix, float_format=args.float_format)
+
+    instrument.write_report()
 
-    all_matrix, all_headers, reference = sort_proteins(args.files, args.reference)
-    packageGeneMatrix(args.output, all_headers, reference, all_matrix)
+if __name__ == '__main__':
+    main()
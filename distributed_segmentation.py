@@ -0,0 +1,368 @@
+'''Distributes batch segmentation of a directory of tif files over several workers (on one or more nodes) using
+a work queue kept on the shared filesystem itself.
+
+Workers claim images by atomically creating a lease file (.ID.lease) next to the image in the input directory, and
+keep it alive by touching it while the image is processed. The lease records its owner (worker, host and process),
+and workers only refresh or remove leases they still own. Leases that have not been touched for longer than the
+lease timeout belong to dead workers and are reclaimed by the remaining workers. Images whose feature file is
+complete are done; each failed attempt at an image is recorded in a .ID.failed file, and images are no longer
+retried once they have failed --max-attempts times. The coordinator clears these markers when it starts a new run
+(workers do so with --retry-failed).
+Each worker writes a report of its throughput and failures to .workers/ in the input directory, and these are
+combined into segmentation_summary.json.
+
+Usage:
+On each node: python distributed_segmentation.py worker (directory of tif files) (location of the bin folder)
+Locally, with N worker processes: python distributed_segmentation.py coordinator (directory) (bin) --workers N
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<https://www.gnu.org/licenses/>.'''
+
+from batch_segmentation import StageCache
+from batch_segmentation import EXTRACT_ARGS
+from batch_segmentation import is_complete
+from batch_segmentation import make_confidence_matrices
+from batch_segmentation import process_image
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import tempfile
+import threading
+import subprocess
+import argparse
+import instrument
+
+def lease_path(inputdir, ID):
+    '''Returns the path of the lease file for an image.'''
+    return inputdir + "." + ID + ".lease"
+
+def lease_owner(worker):
+    '''Returns the owner written into the leases of a worker: its name, host and process, so that two workers with
+    the same name never mistake each other's leases for their own.'''
+    return "%s %s %d" % (worker, socket.gethostname(), os.getpid())
+
+def read_lease(lease):
+    '''Returns the owner recorded in a lease file, or None if it does not exist.'''
+    try:
+        with open(lease) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+def claim_image(inputdir, ID, worker, timeout):
+    '''Tries to claim an image for a worker. Returns "claimed" if a new lease was created, "reclaimed" if a stale
+    lease of a dead worker was taken over, or None if another worker holds the image.'''
+    lease = lease_path(inputdir, ID)
+    reclaimed = False
+    for attempt in range(0, 2):
+        try:
+            fd = os.open(lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError:
+            try:
+                age = time.time() - os.path.getmtime(lease)
+            except OSError:
+                # The lease was released in the meantime; try again
+                continue
+            if age < timeout:
+                return None
+
+            # Move the stale lease out of the way - rename is atomic, so only one worker can take it over
+            stale = lease + "." + worker + ".stale"
+            try:
+                os.rename(lease, stale)
+            except OSError:
+                return None
+            if time.time() - os.path.getmtime(stale) < timeout:
+                # Another worker took it over and refreshed it just before us; put it back
+                try:
+                    os.link(stale, lease)
+                except OSError:
+                    pass
+                os.remove(stale)
+                return None
+            os.remove(stale)
+            reclaimed = True
+            continue
+
+        os.write(fd, (lease_owner(worker) + "\n").encode("utf-8"))
+        os.close(fd)
+        return "reclaimed" if reclaimed else "claimed"
+    return None
+
+def release_image(inputdir, ID, worker):
+    '''Removes the lease on an image, if the worker still owns it (its lease may have been reclaimed by another
+    worker while it was unresponsive). Returns whether the lease was removed.'''
+    lease = lease_path(inputdir, ID)
+    # Move the lease out of the way before checking its owner, so a lease taken over in the meantime is not removed
+    released = lease + "." + worker + "." + str(os.getpid()) + ".release"
+    try:
+        os.rename(lease, released)
+    except OSError:
+        return False
+    if read_lease(released) == lease_owner(worker):
+        os.remove(released)
+        return True
+    # Another worker owns the lease now; put it back
+    try:
+        os.link(released, lease)
+    except OSError:
+        pass
+    os.remove(released)
+    return False
+
+class Heartbeat(threading.Thread):
+    '''Background thread touching a lease file at regular intervals, so other workers know it is still alive.
+    It stops touching the lease (and sets lost) once the lease is owned by another worker.'''
+    def __init__(self, lease, interval, worker):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.lease = lease
+        self.interval = interval
+        self.owner = lease_owner(worker)
+        self.lost = False
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            if read_lease(self.lease) != self.owner:
+                self.lost = True
+                return
+            try:
+                os.utime(self.lease, None)
+            except OSError:
+                pass
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+def failure_path(inputdir, ID):
+    '''Returns the path of the failure marker for an image.'''
+    return inputdir + "." + ID + ".failed"
+
+def failed_attempts(inputdir, ID):
+    '''Returns the number of failed attempts at an image (one line per attempt in its failure marker).'''
+    try:
+        with open(failure_path(inputdir, ID)) as f:
+            return sum(1 for line in f if line.strip() != "")
+    except (IOError, OSError):
+        return 0
+
+def record_failure(inputdir, ID, worker):
+    '''Adds a failed attempt by a worker to the failure marker of an image.'''
+    with open(failure_path(inputdir, ID), "a") as f:
+        f.write(worker + "\n")
+
+def clear_failures(inputdir):
+    '''Removes the failure markers of all images, so that they are retried.'''
+    for name in os.listdir(inputdir):
+        if name.startswith(".") and name.endswith(".failed"):
+            try:
+                os.remove(inputdir + name)
+            except OSError:
+                pass
+
+def pending_images(inputdir, max_attempts=3):
+    '''Lists the tif files in the input directory that have no complete feature file and have failed fewer than
+    max_attempts times.'''
+    images = []
+    for image in sorted(os.listdir(inputdir)):
+        if image.endswith(".tif"):
+            ID = image.split(".")[0]
+            if not is_complete(inputdir + ID + ".txt") and failed_attempts(inputdir, ID) < max_attempts:
+                images.append(image)
+    return images
+
+def run_worker(inputdir, PMbin, worker, timeout=600.0, poll=10.0, cache=None, max_attempts=3,
+               extract_args=EXTRACT_ARGS):
+    '''Claims and processes images from the input directory until none are left (images that failed max_attempts
+    times are given up on), then writes a report of the throughput and failures of this worker to .workers/ in the
+    input directory. Returns the report.'''
+    scratch = tempfile.mkdtemp(prefix="pcp_worker_")
+    confmatrices = scratch + "/Conf_Matrices.scp"
+    confkey = make_confidence_matrices(PMbin, confmatrices, cache)
+
+    report = {"worker": worker, "host": socket.gethostname(), "started": time.time(),
+              "processed": [], "failed": [], "reclaimed": []}
+    try:
+        while True:
+            images = pending_images(inputdir, max_attempts)
+            if len(images) == 0:
+                break
+
+            claimed_any = False
+            for image in images:
+                ID = image.split(".")[0]
+                claim = claim_image(inputdir, ID, worker, timeout)
+                if claim is None:
+                    continue
+                claimed_any = True
+                if claim == "reclaimed":
+                    print ("Reclaimed stale lease on ", image)
+                    report["reclaimed"].append(ID)
+
+                heartbeat = Heartbeat(lease_path(inputdir, ID), timeout / 4.0, worker)
+                heartbeat.start()
+                try:
+                    # Another worker may have finished the image between listing and claiming it
+                    if is_complete(inputdir + ID + ".txt") or failed_attempts(inputdir, ID) >= max_attempts:
+                        continue
+                    try:
+                        _, complete = process_image(image, inputdir, PMbin, confmatrices, confkey, cache,
+                                                    extract_args)
+                    except Exception as e:
+                        print ("ERROR: Could not process image ", image, e)
+                        complete = False
+                    if complete:
+                        report["processed"].append(ID)
+                    else:
+                        report["failed"].append(ID)
+                        record_failure(inputdir, ID, worker)
+                    print ("%s: processed %d images (%d failed)." %
+                           (worker, len(report["processed"]), len(report["failed"])))
+                finally:
+                    heartbeat.stop()
+                    if not release_image(inputdir, ID, worker) or heartbeat.lost:
+                        print ("WARNING: The lease on " + image + " was reclaimed by another worker")
+
+            # All remaining images are leased by other workers - wait for them to finish or for their leases to expire
+            if not claimed_any:
+                time.sleep(poll)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+        report["finished"] = time.time()
+        report["elapsed_seconds"] = report["finished"] - report["started"]
+        hours = report["elapsed_seconds"] / 3600.0
+        report["images_per_hour"] = len(report["processed"]) / hours if hours > 0 else 0.0
+        reportdir = inputdir + ".workers/"
+        if not os.path.isdir(reportdir):
+            try:
+                os.makedirs(reportdir)
+            except OSError:
+                pass
+        with open(reportdir + worker + ".json", "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+def write_summary(inputdir, max_attempts=3):
+    '''Combines the reports of all workers into segmentation_summary.json in the input directory, and prints the
+    throughput and failures of each worker. Images are counted as failed if they failed in this run and still have
+    no complete feature file.'''
+    reportdir = inputdir + ".workers/"
+    reports = []
+    if os.path.isdir(reportdir):
+        for name in sorted(os.listdir(reportdir)):
+            if name.endswith(".json"):
+                with open(reportdir + name) as f:
+                    reports.append(json.load(f))
+
+    summary = {"workers": reports,
+               "processed": sum(len(report["processed"]) for report in reports),
+               "failed": sorted(set(ID for report in reports for ID in report["failed"]
+                                    if not is_complete(inputdir + ID + ".txt"))),
+               "remaining": len(pending_images(inputdir, max_attempts))}
+    with open(inputdir + "segmentation_summary.json", "w") as f:
+        json.dump(summary, f, indent=2)
+
+    for report in reports:
+        print ("%s: %d processed, %d failed, %d reclaimed, %.1f images/hour" %
+               (report["worker"], len(report["processed"]), len(report["failed"]), len(report["reclaimed"]),
+                report["images_per_hour"]))
+    print ("Total: %d processed, %d failed, %d remaining" %
+           (summary["processed"], len(summary["failed"]), summary["remaining"]))
+    return summary
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run batch segmentation on a directory of tif files with several '
+                                                 'workers sharing a work queue on the filesystem.')
+    parser.add_argument("mode", help="worker: process images until none are left; coordinator: launch local "
+                                     "workers and summarize; summary: only summarize the worker reports",
+                        choices=["worker", "coordinator", "summary"])
+    parser.add_argument("directory", help="Input directory containing tif files", type=str)
+    parser.add_argument("bin", help="Location of Budding Yeast Morphologist Programs.", type=str, nargs="?",
+                        default="")
+    parser.add_argument("--workers", help="Number of local workers to launch in coordinator mode", type=int,
+                        default=1)
+    parser.add_argument("--worker-id", help="Name of this worker (defaults to hostname-pid)", type=str, default=None)
+    parser.add_argument("--lease-timeout", help="Seconds after which the lease of a worker that stopped responding "
+                                                "is reclaimed", type=float, default=600.0)
+    parser.add_argument("--poll", help="Seconds to wait between checks for expired leases", type=float, default=10.0)
+    parser.add_argument("--max-attempts", help="Number of times an image is tried before it is given up on",
+                        type=int, default=3)
+    parser.add_argument("--retry-failed", help="Clear the failure markers of earlier runs before starting, so "
+                                               "failed images are tried again (the coordinator always does)",
+                        action="store_true")
+    parser.add_argument("--cache", help="Directory to cache the outputs of each stage in", type=str, default=None)
+    parser.add_argument("--extract-args", help="Parameters of PMExtractFeatures (default '%(default)s')", type=str,
+                        default=EXTRACT_ARGS)
+    parser.add_argument("--cache-size", help="Maximum size of the stage cache in GB", type=float, default=50.0)
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+
+    # Standardize the extensions of the paths
+    inputdir = args.directory
+    if inputdir[-1] != "/":
+        inputdir = inputdir + "/"
+
+    PMbin = args.bin
+    if PMbin != "" and PMbin[-1] != "/":
+        PMbin = PMbin + "/"
+    if PMbin == "" and args.mode != "summary":
+        parser.error("the location of the Budding Yeast Morphologist programs is required")
+
+    if args.mode == "worker":
+        cache = None
+        if args.cache is not None:
+            cache = StageCache(args.cache, int(args.cache_size * 1024 ** 3))
+        worker = args.worker_id
+        if worker is None:
+            worker = socket.gethostname() + "-" + str(os.getpid())
+        if args.retry_failed:
+            clear_failures(inputdir)
+        instrument.enable_from_args(args)
+        run_worker(inputdir, PMbin, worker, args.lease_timeout, args.poll, cache, args.max_attempts,
+                   args.extract_args)
+        instrument.write_report()
+    elif args.mode == "coordinator":
+        # Remove reports and failure markers of earlier runs, then launch the workers as separate processes
+        shutil.rmtree(inputdir + ".workers/", ignore_errors=True)
+        clear_failures(inputdir)
+        processes = []
+        for i in range(0, args.workers):
+            command = [sys.executable, os.path.abspath(__file__), "worker", inputdir, PMbin,
+                       "--worker-id", socket.gethostname() + "-worker" + str(i),
+                       "--lease-timeout", str(args.lease_timeout), "--poll", str(args.poll),
+                       "--max-attempts", str(args.max_attempts), "--extract-args=" + args.extract_args]
+            if args.cache is not None:
+                command += ["--cache", args.cache, "--cache-size", str(args.cache_size)]
+            # Each worker writes its own report and profile, named after the worker
+            if args.report is not None:
+                root, extension = os.path.splitext(args.report)
+                command += ["--report", root + "_worker" + str(i) + extension]
+            if args.profile is not None:
+                profile_file = args.profile_output
+                if profile_file is None:
+                    profile_file = args.profile.replace("/", "_") + ".prof"
+                root, extension = os.path.splitext(profile_file)
+                command += ["--profile", args.profile, "--profile-output", root + "_worker" + str(i) + extension]
+            processes.append(subprocess.Popen(command))
+        for process in processes:
+            process.wait()
+        write_summary(inputdir, args.max_attempts)
+    else:
+        write_summary(inputdir, args.max_attempts)
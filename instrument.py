@@ -0,0 +1,269 @@
+'''Instrumentation of the pipeline scripts: wall time, peak memory and counts of each stage, skipped files, and the
+timings of the Morphologist programs, written as a JSON run report.
+
+Instrumentation is disabled until enable() is called (the scripts call it when given --report or --profile, see
+add_arguments); while disabled, stage() returns a shared no-op context manager and the other functions return
+immediately.
+
+Stages are named with "/" for nesting (e.g. "change/neighbors"), and are aggregated by name: the report gives the
+number of calls, total and longest wall time, the peak RSS of the process when the stage ended, and the counts (rows,
+cells, files...) added while it ran. Records made in worker processes are sent back with the results of each task
+(see call and merged). When a profiled stage runs in worker processes, each worker dumps its profile next to the
+profile file (profile_file.pid), and the parent merges them into the profile file.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<https://www.gnu.org/licenses/>.'''
+
+import os
+import sys
+import json
+import time
+import threading
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# State of the run report while instrumentation is enabled (None while disabled)
+REPORT = None
+
+class _Disabled(object):
+    '''No-op context manager returned by stage() while instrumentation is disabled.'''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+DISABLED = _Disabled()
+
+def peak_rss():
+    '''Returns the peak resident set size of this process so far, in MB (None if unavailable)'''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, and in kilobytes elsewhere
+    return peak / 1024.0 ** 2 if sys.platform == "darwin" else peak / 1024.0
+
+def enable(report_file=None, profile_stage=None, profile_file=None):
+    '''Enables instrumentation. The report is written to report_file by write_report(); if profile_stage is given,
+    every run of that stage is profiled with cProfile, and the statistics written to profile_file.'''
+    global REPORT
+    # cProfile is only imported when profiling, so scripts run without instrumentation don't pay for it at startup
+    if profile_stage is not None:
+        import cProfile
+    REPORT = {"report_file": report_file, "profile_stage": profile_stage, "profile_file": profile_file,
+              "profiler": cProfile.Profile() if profile_stage is not None else None, "started": time.time(),
+              "pid": os.getpid(), "profiler_pid": os.getpid(), "profiles": set(), "stack": threading.local(),
+              "stages": {}, "skipped": [], "subprocesses": []}
+
+def enabled():
+    '''Returns whether instrumentation is enabled'''
+    return REPORT is not None
+
+class _Stage(object):
+    '''Context manager recording one run of a stage.'''
+    def __init__(self, name, counts):
+        self.name = name
+        self.counts = counts
+
+    def __enter__(self):
+        _stack().append(self)
+        self.start = time.perf_counter()
+        if self.name == REPORT["profile_stage"]:
+            REPORT["profiler"].enable()
+        return self
+
+    def __exit__(self, *exc):
+        if self.name == REPORT["profile_stage"]:
+            REPORT["profiler"].disable()
+        seconds = time.perf_counter() - self.start
+        _stack().pop()
+        _add_stage(self.name, 1, seconds, seconds, peak_rss(), self.counts)
+        return False
+
+def _stack():
+    '''Returns the stages running in this thread, innermost last'''
+    local = REPORT["stack"]
+    if not hasattr(local, "stages"):
+        local.stages = []
+    return local.stages
+
+def _add_stage(name, calls, seconds, max_seconds, rss, counts):
+    '''Adds runs of a stage to its aggregated record'''
+    record = REPORT["stages"].setdefault(name, {"calls": 0, "seconds": 0.0, "max_seconds": 0.0,
+                                                "peak_rss_mb": None, "counts": {}})
+    record["calls"] += calls
+    record["seconds"] += seconds
+    record["max_seconds"] = max(record["max_seconds"], max_seconds)
+    if rss is not None:
+        record["peak_rss_mb"] = max(record["peak_rss_mb"] or 0, rss)
+    for key, value in counts.items():
+        record["counts"][key] = record["counts"].get(key, 0) + value
+
+def stage(name, **counts):
+    '''Context manager timing a stage, e.g. with stage("change/neighbors", rows=n): ...
+    Keyword arguments are added to the counts of the stage.'''
+    if REPORT is None:
+        return DISABLED
+    return _Stage(name, dict(counts))
+
+def count(**counts):
+    '''Adds to the counts of the innermost running stage (e.g. count(cells=n))'''
+    if REPORT is None or len(_stack()) == 0:
+        return
+    current = _stack()[-1].counts
+    for key, value in counts.items():
+        current[key] = current.get(key, 0) + value
+
+def skip(path, reason):
+    '''Records a file that was skipped, and why'''
+    if REPORT is None:
+        return
+    REPORT["skipped"].append({"file": path, "reason": reason})
+
+def subprocess_run(program, seconds, returncode, cached=False, **details):
+    '''Records a run of an external program (e.g. a Morphologist stage), with its wall time and return code
+    (None if its outputs were taken from a cache), and the innermost running stage'''
+    if REPORT is None:
+        return
+    stages = _stack()
+    record = {"program": program, "seconds": seconds, "returncode": returncode, "cached": cached,
+              "stage": stages[-1].name if len(stages) > 0 else None}
+    record.update(details)
+    REPORT["subprocesses"].append(record)
+
+def drain():
+    '''Returns the records made in this process since the last drain, and clears them (used in worker processes)'''
+    if REPORT is None:
+        return None
+    records = {"stages": REPORT["stages"], "skipped": REPORT["skipped"], "subprocesses": REPORT["subprocesses"]}
+    REPORT["stages"], REPORT["skipped"], REPORT["subprocesses"] = {}, [], []
+    return records
+
+def merge(records):
+    '''Adds records drained in a worker process to the report of this process'''
+    if REPORT is None or records is None:
+        return
+    for name, record in records["stages"].items():
+        _add_stage(name, record["calls"], record["seconds"], record["max_seconds"], record["peak_rss_mb"],
+                   record["counts"])
+    REPORT["skipped"] += records["skipped"]
+    REPORT["subprocesses"] += records["subprocesses"]
+    REPORT["profiles"].update(records.get("profiles", []))
+
+def call(function, args):
+    '''Calls function(*args), returning its result with the records made during the call, so that the records of
+    tasks run in worker processes reach the report (see merged)'''
+    if REPORT is None:
+        return function(*args), None
+    worker = os.getpid() != REPORT["pid"]
+    if worker and REPORT["profiler"] is not None and REPORT["profiler_pid"] != os.getpid():
+        # Profile this worker from scratch, instead of adding to what was inherited from the parent process
+        import cProfile
+        REPORT["profiler"], REPORT["profiler_pid"] = cProfile.Profile(), os.getpid()
+    # Set aside the records made before the call (in a worker process, those inherited from the parent process)
+    earlier = drain()
+    result = function(*args)
+    records = drain()
+    merge(earlier)
+    if worker and REPORT["profiler"] is not None and REPORT["profile_file"] is not None:
+        # The profile of a worker covers all of its calls so far, so later dumps replace earlier ones
+        profile_file = REPORT["profile_file"] + "." + str(os.getpid())
+        REPORT["profiler"].create_stats()
+        if len(REPORT["profiler"].stats) > 0:
+            REPORT["profiler"].dump_stats(profile_file)
+            records["profiles"] = [profile_file]
+    return result, records
+
+def merged(results):
+    '''Merges the records of results returned by call, and yields the results themselves'''
+    for result, records in results:
+        merge(records)
+        yield result
+
+def summarize_subprocesses(runs):
+    '''Aggregates the runs of external programs by program'''
+    programs = {}
+    for run in runs:
+        summary = programs.setdefault(run["program"], {"calls": 0, "cached": 0, "failed": 0, "seconds": 0.0,
+                                                       "max_seconds": 0.0})
+        summary["calls"] += 1
+        summary["cached"] += 1 if run["cached"] else 0
+        summary["failed"] += 1 if run["returncode"] not in (0, None) else 0
+        summary["seconds"] += run["seconds"]
+        summary["max_seconds"] = max(summary["max_seconds"], run["seconds"])
+    return programs
+
+def write_report():
+    '''Writes the run report (if a report file was given) and the profile statistics (if a stage was profiled)'''
+    if REPORT is None:
+        return
+    if REPORT["profiler"] is not None and REPORT["profile_file"] is not None:
+        write_profile()
+    if REPORT["report_file"] is None:
+        return
+
+    finished = time.time()
+    report = {"command": sys.argv, "pid": os.getpid(), "started": REPORT["started"], "finished": finished,
+              "elapsed_seconds": finished - REPORT["started"], "peak_rss_mb": peak_rss(),
+              "stages": REPORT["stages"], "skipped": REPORT["skipped"],
+              "subprocess_summary": summarize_subprocesses(REPORT["subprocesses"]),
+              "subprocesses": REPORT["subprocesses"]}
+    if resource is not None:
+        children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        report["children_peak_rss_mb"] = children / 1024.0 ** 2 if sys.platform == "darwin" else children / 1024.0
+    with open(REPORT["report_file"], "w") as f:
+        json.dump(report, f, indent=1)
+    print ("Written run report to file " + REPORT["report_file"])
+
+def write_profile():
+    '''Writes the profile of the profiled stage, merged with the profiles dumped by worker processes (which are
+    removed), to the profile file. Nothing is written if the stage never ran.'''
+    import pstats
+    stats = None
+    REPORT["profiler"].create_stats()
+    if len(REPORT["profiler"].stats) > 0:
+        stats = pstats.Stats(REPORT["profiler"])
+    for profile_file in sorted(REPORT["profiles"]):
+        if stats is None:
+            stats = pstats.Stats(profile_file)
+        else:
+            stats.add(profile_file)
+        os.remove(profile_file)
+    if stats is None:
+        print ("Stage " + REPORT["profile_stage"] + " did not run, no profile written")
+        return
+    stats.dump_stats(REPORT["profile_file"])
+    print ("Written profile of stage " + REPORT["profile_stage"] + " to file " + REPORT["profile_file"] +
+           (" (merged from %d worker processes)" % len(REPORT["profiles"]) if len(REPORT["profiles"]) > 0 else ""))
+
+def add_arguments(parser):
+    '''Adds the --report and --profile options to the argument parser of a script'''
+    parser.add_argument("--report", help="Write a JSON report of the wall time, peak memory and counts of each "
+                                         "stage, and of skipped files, to this file", type=str, default=None)
+    parser.add_argument("--profile", help="Profile every run of this stage with cProfile (e.g. change/neighbors), "
+                                          "writing the statistics to --profile-output", type=str, default=None)
+    parser.add_argument("--profile-output", help="File to write the profile statistics to (default "
+                                                 "(stage).prof)", type=str, default=None)
+
+def enable_from_args(args):
+    '''Enables instrumentation if --report or --profile was given (see add_arguments)'''
+    if args.report is None and args.profile is None:
+        return
+    profile_file = args.profile_output
+    if args.profile is not None and profile_file is None:
+        profile_file = args.profile.replace("/", "_") + ".prof"
+    enable(args.report, args.profile, profile_file)
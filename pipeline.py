@@ -0,0 +1,179 @@
+'''In-memory pipeline from single-cell feature files to concatenated protein change profiles.
+
+Chains the steps of average_single_cells.py, calculate_protein_change_profiles.py and concatenate_profiles.py without
+writing and re-parsing the intermediate files. Each stage is memoized by a hash of its inputs and parameters, so after
+the files of one screen change only that screen's averaged features and change profile (and the concatenation) are
+recomputed. Results computed from a screen are dropped from memory when the screen is replaced. Results are only
+written to disk when asked for with materialize().
+
+Example:
+    pipeline = Pipeline(k=50)
+    pipeline.add_screen("WT2", averaged="examples/WT2_averaged_features.txt")
+    pipeline.add_screen("ALP3", files=glob.glob("ALP3/*.txt"), group_pattern="^([^_]+)_")
+    pipeline.add_screen("RAP3", averaged="examples/RAP3_averaged_features.txt")
+    all_headers, proteins, all_matrix = pipeline.concatenated("WT2", ["ALP3", "RAP3"], "protein_list.txt")
+    pipeline.materialize("output", "WT2", ["ALP3", "RAP3"], "protein_list.txt")
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<https://www.gnu.org/licenses/>.'''
+
+from util import openGeneMatrix
+from util import packageGeneMatrix
+from util import hash_file
+from average_single_cells import HEADERS
+from average_single_cells import average_files
+from average_single_cells import group_files
+from calculate_protein_change_profiles import calculateModZScores
+from calculate_protein_change_profiles import intersect_rows
+from calculate_protein_change_profiles import modWeights
+from calculate_protein_change_profiles import subtract_matrices
+from concatenate_profiles import fill_sorted
+import os
+import hashlib
+import collections
+import numpy as np
+
+def stage_key(*parts):
+    '''Returns the hash of the inputs and parameters of a stage.'''
+    return hashlib.sha256(repr(parts).encode("utf-8")).hexdigest()
+
+class Pipeline(object):
+    '''Memoized in-memory pipeline of averaging, change profile and concatenation stages.
+    Matrices are cast to float32 when passed to the next stage, the precision they have when read back from files,
+    so results match running the scripts one after the other.'''
+    def __init__(self, k=50, metric='euclidean', block_size=1024, dtype=np.float64, zero_mad='nan'):
+        self.k = k
+        self.metric = metric
+        self.block_size = block_size
+        self.dtype = dtype
+        self.zero_mad = zero_mad
+        self.screens = {}
+        self.memo = {}
+
+    def add_screen(self, name, files=None, averaged=None, group_pattern=None):
+        '''Adds (or replaces) a screen, given either its single-cell feature files or its averaged features file.
+        With group_pattern, single-cell files are pooled into one row per protein (see average_single_cells.py).
+        Files are averaged by name, so single-cell files of a screen must have different names (even if they are in
+        different directories).'''
+        if (files is None) == (averaged is None):
+            raise ValueError("Give either the single-cell files or the averaged features file of screen " + name)
+        if files is not None:
+            files = sorted(os.path.abspath(f) for f in files)
+            counts = collections.Counter(os.path.basename(f) for f in files)
+            duplicates = sorted(f for f, count in counts.items() if count > 1)
+            if len(duplicates) > 0:
+                raise ValueError("Single-cell files of screen " + name + " with the same name in different "
+                                 "directories: " + ", ".join(duplicates))
+            key = stage_key("average", group_pattern, [(f, hash_file(f)) for f in files])
+        else:
+            key = stage_key("averaged", hash_file(averaged))
+        self.screens[name] = {"files": files, "averaged": averaged, "group_pattern": group_pattern, "key": key}
+        self._prune()
+
+    def _memoized(self, key, compute, screens):
+        '''Returns the memoized result of a stage, computing it if its inputs or parameters changed. The result is
+        kept until one of the screens it was computed from (given by their keys) is replaced.'''
+        if key not in self.memo:
+            self.memo[key] = (set(screens), compute())
+        return self.memo[key][1]
+
+    def _prune(self):
+        '''Drops the memoized results of stages computed from screens that have since been replaced.'''
+        current = set(screen["key"] for screen in self.screens.values())
+        for key in [key for key, (screens, result) in self.memo.items() if not screens <= current]:
+            del self.memo[key]
+
+    def averaged(self, name):
+        '''Averaged features of a screen.
+        Output: feature labels, gene labels and gene matrix, as returned by openGeneMatrix'''
+        screen = self.screens[name]
+
+        def compute():
+            if screen["averaged"] is not None:
+                headers, genelist, genematrix = openGeneMatrix(screen["averaged"])
+                return headers, genelist, np.asarray(genematrix)
+
+            # Files are grouped by name (names are unique within a screen, see add_screen)
+            paths = dict((os.path.basename(f), f) for f in screen["files"])
+            rows = []
+            for unit, files in group_files(list(paths.keys()), screen["group_pattern"]):
+                unit, final_features, messages = average_files(unit, [paths[f] for f in files])
+                for message in messages:
+                    print (message)
+                if final_features != []:
+                    rows.append((unit, final_features))
+            genematrix = np.array([row[1] for row in rows], dtype=np.float64).reshape(len(rows), len(HEADERS) - 1)
+            return np.array(HEADERS), np.array([row[0] for row in rows]), genematrix
+        return self._memoized(screen["key"], compute, [screen["key"]])
+
+    def _change_key(self, reference, condition):
+        return stage_key("change", self.screens[reference]["key"], self.screens[condition]["key"], self.k,
+                         self.metric, np.dtype(self.dtype).name, self.zero_mad)
+
+    def change_profile(self, reference, condition):
+        '''Protein change profiles of a condition against a reference screen.
+        Output: feature labels, gene labels and z-scores'''
+        def compute():
+            ref_headers, ref_genelist, ref_genematrix = self.averaged(reference)
+            cond_headers, cond_genelist, cond_genematrix = self.averaged(condition)
+            intersect, ref_rows, cond_rows = intersect_rows(ref_genelist, cond_genelist)
+            sorted_ref = ref_genematrix[ref_rows].astype(np.float32)
+            subtracted = subtract_matrices(sorted_ref, cond_genematrix[cond_rows].astype(np.float32))
+            medians, MAD = modWeights(self.k, subtracted, sorted_ref, metric=self.metric, block_size=self.block_size,
+                                      dtype=self.dtype, zero_mad=self.zero_mad)
+            zscores = calculateModZScores(subtracted, medians, MAD, dtype=self.dtype)
+            return ref_headers, intersect, zscores
+        return self._memoized(self._change_key(reference, condition), compute,
+                              [self.screens[reference]["key"], self.screens[condition]["key"]])
+
+    def concatenated(self, reference, conditions, reference_list):
+        '''Change profiles of several conditions against a reference screen, sorted by the list of all proteins
+        and concatenated (see concatenate_profiles.py).
+        Output: concatenated feature labels, list of all proteins, and concatenated matrix'''
+        with open(reference_list, 'r') as f:
+            proteins = [line.rstrip('\n') for line in f]
+        key = stage_key("concatenate", [self._change_key(reference, c) for c in conditions], proteins)
+
+        def compute():
+            profiles = [self.change_profile(reference, condition) for condition in conditions]
+            all_headers = ["PROTEIN"]
+            for condition, (headers, genelist, zscores) in zip(conditions, profiles):
+                all_headers += [condition + "_change_" + header for header in headers[1:]]
+
+            all_matrix = np.empty((len(proteins), len(all_headers) - 1))
+            start = 0
+            for condition, (headers, genelist, zscores) in zip(conditions, profiles):
+                fill_sorted(all_matrix[:, start:start + zscores.shape[1]], genelist, zscores.astype(np.float32),
+                            proteins, screen_name=condition)
+                start += zscores.shape[1]
+            return all_headers, proteins, all_matrix
+        return self._memoized(key, compute, [self.screens[name]["key"] for name in [reference] + list(conditions)])
+
+    def materialize(self, outdir, reference, conditions, reference_list=None, extension=".txt"):
+        '''Writes the averaged features of every screen, the change profile of every condition, and (given the list
+        of all proteins) the concatenated profiles to outdir, as (screen)_averaged_features.txt,
+        (condition)_change.txt and concatenated_profiles.txt.'''
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        for name in [reference] + list(conditions):
+            headers, genelist, genematrix = self.averaged(name)
+            packageGeneMatrix(os.path.join(outdir, name + "_averaged_features" + extension), headers, genelist,
+                              genematrix)
+        for condition in conditions:
+            headers, genelist, zscores = self.change_profile(reference, condition)
+            packageGeneMatrix(os.path.join(outdir, condition + "_change" + extension), headers, genelist, zscores)
+        if reference_list is not None:
+            all_headers, proteins, all_matrix = self.concatenated(reference, conditions, reference_list)
+            packageGeneMatrix(os.path.join(outdir, "concatenated_profiles" + extension), all_headers, proteins,
+                              all_matrix)
@@ -0,0 +1,176 @@
+'''Single command for the stages of the pipeline, with a server mode that keeps libraries and gene matrices loaded.
+
+The stages are run as subcommands, with the same arguments as their scripts:
+    protein-change-profiles segment (directory of tif files) (bin folder)
+    protein-change-profiles average (directory of feature files) (output file)
+    protein-change-profiles change (wild-type screen) (perturbation screen) (output file)
+    protein-change-profiles batch (wild-type screen) -conditions (perturbation screens) -outdir (output directory)
+    protein-change-profiles bootstrap (wild-type screen) (perturbation screen) (output file)
+    protein-change-profiles concatenate -files (profile files) -output (output file) -reference (protein list)
+Only the module of the subcommand is imported, and the scripts import sklearn only when they need it, so the command
+starts quickly.
+
+To avoid paying for interpreter startup and imports on every call, start a server on a local socket:
+    protein-change-profiles serve /tmp/pcp.sock
+and send jobs to it with --server, from any directory (relative paths are resolved in the directory of the client):
+    protein-change-profiles --server /tmp/pcp.sock change WT.txt HU.txt HU_profiles.txt
+The server runs jobs one at a time, streams their output back to the client, and keeps the gene matrices it opened in
+memory (see util.MEMORY_CACHE) for the next jobs, as long as the files do not change.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<https://www.gnu.org/licenses/>.'''
+
+import os
+import sys
+import json
+import socket
+import argparse
+import importlib
+import traceback
+import collections
+import socketserver
+import instrument
+
+PROG = "protein-change-profiles"
+
+# Module of each subcommand, imported only when the subcommand is run
+SUBCOMMANDS = collections.OrderedDict([("segment", "batch_segmentation"), ("average", "average_single_cells"),
+                                       ("change", "calculate_protein_change_profiles"),
+                                       ("batch", "batch_change_profiles"),
+                                       ("bootstrap", "bootstrap_change_profiles"),
+                                       ("concatenate", "concatenate_profiles")])
+
+def run(command, argv):
+    '''Runs a subcommand with the given arguments, and returns its exit code'''
+    module = importlib.import_module(SUBCOMMANDS[command])
+    try:
+        module.main(argv, prog=PROG + " " + command)
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        print (e.code, file=sys.stderr)
+        return 1
+    return 0
+
+class _Stream(object):
+    '''File-like object sending what is written to it to the client, as JSON lines'''
+    def __init__(self, connection, name):
+        self.connection = connection
+        self.name = name
+
+    def write(self, text):
+        if len(text) > 0:
+            self.connection.sendall((json.dumps({self.name: text}) + "\n").encode("utf-8"))
+        return len(text)
+
+    def flush(self):
+        pass
+
+class _JobHandler(socketserver.StreamRequestHandler):
+    '''Runs one job sent by a client: a JSON line with the subcommand, its arguments and the working directory'''
+    def handle(self):
+        try:
+            job = json.loads(self.rfile.readline().decode("utf-8"))
+        except ValueError:
+            return
+        stdout, stderr, cwd = sys.stdout, sys.stderr, os.getcwd()
+        sys.stdout, sys.stderr = _Stream(self.connection, "stdout"), _Stream(self.connection, "stderr")
+        try:
+            os.chdir(job["cwd"])
+            if job["command"] not in SUBCOMMANDS:
+                print ("Unknown subcommand " + job["command"], file=sys.stderr)
+                code = 2
+            else:
+                code = run(job["command"], job["argv"])
+        except Exception:
+            traceback.print_exc()
+            code = 1
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+            os.chdir(cwd)
+            # A job run with --report must not leave instrumentation enabled for the next jobs
+            instrument.REPORT = None
+        try:
+            self.connection.sendall((json.dumps({"exit": code}) + "\n").encode("utf-8"))
+        except OSError:
+            pass
+
+def serve(path, cache_entries=64):
+    '''Runs jobs sent to a Unix socket at the given path, one at a time, until interrupted'''
+    import util
+    # Import the stages and their libraries now, so that jobs do not pay for them
+    for module in SUBCOMMANDS.values():
+        importlib.import_module(module)
+    import sklearn.metrics.pairwise
+    import sklearn.neighbors
+    util.MEMORY_CACHE = collections.OrderedDict()
+    # Cached matrices are shared between jobs and read-only anyway, so map binary matrices instead of copying them
+    util.MMAP_GENE_MATRICES = True
+    util.MEMORY_CACHE_SIZE = cache_entries
+
+    if os.path.exists(path):
+        os.remove(path)
+    server = socketserver.UnixStreamServer(path, _JobHandler)
+    print ("Serving on " + path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+
+def submit(path, command, argv):
+    '''Sends a job to a server, writes its output to stdout and stderr, and returns its exit code'''
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(path)
+    client.sendall((json.dumps({"command": command, "argv": argv, "cwd": os.getcwd()}) + "\n").encode("utf-8"))
+    code = 1
+    with client.makefile("rb") as lines:
+        for line in lines:
+            message = json.loads(line.decode("utf-8"))
+            if "stdout" in message:
+                sys.stdout.write(message["stdout"])
+            elif "stderr" in message:
+                sys.stderr.write(message["stderr"])
+            elif "exit" in message:
+                code = message["exit"]
+    client.close()
+    return code
+
+def main(argv=None):
+    '''Runs the protein-change-profiles command (argv defaults to sys.argv[1:])'''
+    parser = argparse.ArgumentParser(prog=PROG, description='Run a stage of the protein change profile pipeline, or '
+                                                            'serve jobs over a local socket. Run "' + PROG +
+                                                            ' (subcommand) -h" for the arguments of each stage.')
+    parser.add_argument("--server", help="Send the job to the server listening on this socket instead of running it "
+                                         "in this process", type=str, default=None)
+    parser.add_argument("--cache-entries", help="In serve mode, number of gene matrices to keep in memory",
+                        type=int, default=64)
+    parser.add_argument("command", help="Stage to run, or serve (socket path) to start a server",
+                        choices=list(SUBCOMMANDS.keys()) + ["serve"])
+    parser.add_argument("args", nargs=argparse.REMAINDER, help="Arguments of the stage")
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        if len(args.args) != 1:
+            parser.error("serve takes the path of the socket to listen on")
+        serve(args.args[0], args.cache_entries)
+    elif args.server is not None:
+        sys.exit(submit(args.server, args.command, args.args))
+    else:
+        sys.exit(run(args.command, args.args))
+
+if __name__ == '__main__':
+    main()
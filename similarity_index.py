@@ -0,0 +1,210 @@
+'''Find the proteins whose change profiles are most similar, using an index built from concatenated profiles.
+
+Concatenated profiles have NaN blocks for proteins missing from a screen, so similarities are calculated over the
+features observed in both proteins only. The index stores the profiles with NaNs set to zero, their squares and the
+mask of observed features, so the sums over the co-observed features of every pair of proteins are matrix products:
+e.g. the sum of squares of protein i over the features observed in protein j is (squares x mask^T)[i, j]. Similarities
+are calculated for block_size query proteins at a time, so memory is bounded by block_size x proteins.
+
+Example:
+    python similarity_index.py build profiles_index -profiles concatenated_profiles.txt
+    python similarity_index.py query profiles_index -proteins TOP2 ALP1 --top 10
+    python similarity_index.py all profiles_index -output neighbors.txt --top 10
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<https://www.gnu.org/licenses/>.'''
+
+from util import openGeneMatrix
+from util import indexGeneList
+from util import lookupGenes
+import os
+import json
+import argparse
+import numpy as np
+
+METRICS = ["pearson", "cosine"]
+
+def build_index(profiles, directory):
+    '''Builds a similarity index from a concatenated profiles file (or any gene matrix), and writes it to a directory
+    Inputs: path of the profiles, index directory
+    Output: writes values.npy (profiles with NaNs set to zero), squares.npy, mask.npy (1 where a feature is observed)
+    and labels.json to the directory'''
+    headers, genelist, genematrix = openGeneMatrix(profiles, mmap=True)
+    genematrix = np.asarray(genematrix, dtype=np.float64)
+    mask = ~np.isnan(genematrix)
+    values = np.where(mask, genematrix, 0)
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    np.save(os.path.join(directory, "values.npy"), values)
+    np.save(os.path.join(directory, "squares.npy"), values * values)
+    np.save(os.path.join(directory, "mask.npy"), mask.astype(np.float64))
+    with open(os.path.join(directory, "labels.json"), "w") as f:
+        json.dump({"headers": [str(header) for header in headers], "genes": [str(gene) for gene in genelist]}, f)
+    print ("Indexed %d proteins with %d features in %s" % (values.shape[0], values.shape[1], directory))
+
+class SimilarityIndex(object):
+    '''Similarity index built by build_index. The arrays are memory-mapped, so opening an index is cheap.'''
+    def __init__(self, directory):
+        with open(os.path.join(directory, "labels.json")) as f:
+            labels = json.load(f)
+        self.headers = labels["headers"]
+        self.genes = labels["genes"]
+        self.index, _ = indexGeneList(self.genes)
+        self.values = np.load(os.path.join(directory, "values.npy"), mmap_mode='r')
+        self.squares = np.load(os.path.join(directory, "squares.npy"), mmap_mode='r')
+        self.mask = np.load(os.path.join(directory, "mask.npy"), mmap_mode='r')
+
+    def rows(self, genes):
+        '''Returns the rows of the given proteins, raising a KeyError for proteins that are not in the index'''
+        rows = lookupGenes(self.index, genes)
+        missing = [gene for gene, row in zip(genes, rows) if row < 0]
+        if len(missing) > 0:
+            raise KeyError("Proteins not in the index: " + ", ".join(missing))
+        return rows
+
+    def similarities(self, rows, metric="pearson", min_overlap=10):
+        '''Calculates the similarity of the given proteins to every protein, over their co-observed features
+        Similarities of pairs with fewer than min_overlap co-observed features (or no variance) are NaN
+        Inputs: rows of the query proteins, metric ('pearson' or 'cosine'), minimum number of co-observed features
+        Output: (queries x proteins) similarities, and number of co-observed features'''
+        values = self.values[rows]
+        squares = self.squares[rows]
+        mask = self.mask[rows]
+
+        overlap = mask.dot(self.mask.T)
+        products = values.dot(self.values.T)
+        # Sums of squares of the queries over the features observed in each protein, and vice versa
+        query_squares = squares.dot(self.mask.T)
+        other_squares = mask.dot(self.squares.T)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if metric == "cosine":
+                similarity = products / np.sqrt(query_squares * other_squares)
+            else:
+                query_sums = values.dot(self.mask.T)
+                other_sums = mask.dot(self.values.T)
+                covariance = overlap * products - query_sums * other_sums
+                query_variance = overlap * query_squares - query_sums * query_sums
+                other_variance = overlap * other_squares - other_sums * other_sums
+                similarity = covariance / np.sqrt(query_variance * other_variance)
+        similarity[(overlap < min_overlap) | ~np.isfinite(similarity)] = np.nan
+        return similarity, overlap.astype(np.int64)
+
+    def top(self, rows, k=10, metric="pearson", min_overlap=10, block_size=256):
+        '''Finds the k most similar proteins to each of the given proteins (excluding the protein itself)
+        Inputs: rows of the query proteins, k, metric, minimum number of co-observed features, block size
+        Output: (queries x k) rows of the most similar proteins sorted from most to least similar, their similarities
+        and their numbers of co-observed features (rows of -1 and NaN similarities if there are fewer than k)'''
+        rows = np.asarray(rows, dtype=np.int64)
+        k = min(k, len(self.genes) - 1)
+        nearest = np.full((len(rows), k), -1, dtype=np.int64)
+        similarity = np.full((len(rows), k), np.nan)
+        overlap = np.zeros((len(rows), k), dtype=np.int64)
+        for start in range(0, len(rows), block_size):
+            end = min(start + block_size, len(rows))
+            block, block_overlap = self.similarities(rows[start:end], metric, min_overlap)
+            block[np.arange(end - start), rows[start:end]] = np.nan
+
+            # Select the k most similar without sorting the whole row, then sort only those k
+            scores = np.where(np.isnan(block), -np.inf, block)
+            candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            order = np.argsort(-np.take_along_axis(scores, candidates, axis=1), axis=1, kind='stable')
+            candidates = np.take_along_axis(candidates, order, axis=1)
+
+            found = ~np.isnan(np.take_along_axis(block, candidates, axis=1))
+            nearest[start:end] = np.where(found, candidates, -1)
+            similarity[start:end] = np.where(found, np.take_along_axis(block, candidates, axis=1), np.nan)
+            overlap[start:end] = np.where(found, np.take_along_axis(block_overlap, candidates, axis=1), 0)
+        return nearest, similarity, overlap
+
+    def neighbors(self, rows, k=10, metric="pearson", min_overlap=10, block_size=256):
+        '''Finds the k most similar proteins to each of the given proteins like top, by name
+        Output: list of (query protein, list of (protein, similarity, co-observed features))'''
+        nearest, similarity, overlap = self.top(rows, k, metric, min_overlap, block_size)
+        return [(self.genes[row], [(self.genes[other], s, o) for other, s, o in zip(nearest[i], similarity[i],
+                                                                                  overlap[i]) if other >= 0])
+                for i, row in enumerate(rows)]
+
+    def query(self, genes, k=10, metric="pearson", min_overlap=10):
+        '''Finds the k most similar proteins to each of the given proteins, by name (see neighbors)'''
+        return self.neighbors(self.rows(genes), k, metric, min_overlap)
+
+    def all_pairs(self, matrixfile, metric="pearson", min_overlap=10, block_size=256):
+        '''Writes the similarities of all pairs of proteins to a (proteins x proteins) float32 .npy file, calculated
+        block_size proteins at a time so memory is bounded by block_size x proteins'''
+        n = len(self.genes)
+        matrix = np.lib.format.open_memmap(matrixfile, mode='w+', dtype=np.float32, shape=(n, n))
+        for start in range(0, n, block_size):
+            end = min(start + block_size, n)
+            matrix[start:end] = self.similarities(np.arange(start, end), metric, min_overlap)[0]
+        matrix.flush()
+
+def write_neighbors(outputfile, results):
+    '''Writes the most similar proteins of each query protein, one line per pair, to a tab-separated file'''
+    with open(outputfile, "w") as f:
+        f.write("PROTEIN\tRANK\tSIMILAR_PROTEIN\tSIMILARITY\tCO_OBSERVED\n")
+        for gene, neighbors in results:
+            for rank, (other, similarity, overlap) in enumerate(neighbors):
+                f.write("%s\t%d\t%s\t%s\t%d\n" % (gene, rank + 1, other, str(similarity), overlap))
+    print ("Written to file " + outputfile)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build and query an index of the similarity between protein '
+                                                 'change profiles, over the features observed in both proteins.')
+    parser.add_argument("mode", help="build: index a concatenated profiles file; query: find the most similar "
+                                     "proteins to the given proteins; all: find the most similar proteins to every "
+                                     "protein", choices=["build", "query", "all"])
+    parser.add_argument("index", help="Index directory", type=str)
+    parser.add_argument("-profiles", help="Concatenated profiles file to index (build mode)", type=str, default=None)
+    parser.add_argument("-proteins", nargs='+', help="Proteins to query (query mode)", default=None)
+    parser.add_argument("-output", help="File to write the most similar proteins to (printed in query mode if not "
+                                        "given)", type=str, default=None)
+    parser.add_argument("--top", help="Number of most similar proteins to find for each protein", type=int,
+                        default=10)
+    parser.add_argument("--metric", help="Similarity over the co-observed features", choices=METRICS,
+                        default="pearson")
+    parser.add_argument("--min-overlap", help="Minimum number of co-observed features for a pair of proteins to be "
+                                              "compared", type=int, default=10)
+    parser.add_argument("--block-size", help="Number of proteins to calculate similarities for at a time (bounds "
+                                             "memory use)", type=int, default=256)
+    parser.add_argument("--matrix", help="In all mode, also write the similarities of all pairs of proteins to "
+                                         "this .npy file", type=str, default=None)
+    args = parser.parse_args()
+
+    if args.mode == "build":
+        if args.profiles is None:
+            parser.error("-profiles is required in build mode")
+        build_index(args.profiles, args.index)
+    elif args.mode == "query":
+        if args.proteins is None:
+            parser.error("-proteins is required in query mode")
+        index = SimilarityIndex(args.index)
+        results = index.query(args.proteins, args.top, args.metric, args.min_overlap)
+        if args.output is not None:
+            write_neighbors(args.output, results)
+        else:
+            for gene, neighbors in results:
+                print (gene + ": " + ", ".join("%s (%.3f)" % (other, similarity)
+                                               for other, similarity, overlap in neighbors))
+    else:
+        if args.output is None:
+            parser.error("-output is required in all mode")
+        index = SimilarityIndex(args.index)
+        results = index.neighbors(np.arange(len(index.genes)), args.top, args.metric, args.min_overlap,
+                                  args.block_size)
+        write_neighbors(args.output, results)
+        if args.matrix is not None:
+            index.all_pairs(args.matrix, args.metric, args.min_overlap, args.block_size)
+            print ("Written to file " + args.matrix)
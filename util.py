@@ -22,13 +22,81 @@ along with this program.  If not, see
 <https://www.gnu.org/licenses/>.'''
 
 import csv
+import gzip
+import json
+import os
+import hashlib
+import tempfile
+import instrument
 import numpy as np
 
-def openGeneMatrix(fileName):
+# Gene matrices can also be stored in a binary format: the float32 matrix as a .npy file (which can be memory-mapped
+# so loads don't copy or parse anything), with the feature and gene labels in a .json file next to it.
+# Text gene matrices are automatically cached in this format next to the text file (fileName + ".npy"); the cache
+# is only used while the size and modification time of the text file are unchanged.
+# Binary matrices are loaded into memory unless memory-mapping is asked for (mmap=True, or MMAP_GENE_MATRICES), in
+# which case matrices are read-only whether they were mapped from a binary or parsed from text.
+BINARY_EXTENSION = ".npy"
+CACHE_GENE_MATRICES = True
+MMAP_GENE_MATRICES = False
+
+# Long-running processes (see protein_change_profiles.py serve) can also keep the last MEMORY_CACHE_SIZE gene matrices
+# they opened in memory, as long as the files are unchanged. MEMORY_CACHE is None (disabled) by default.
+MEMORY_CACHE = None
+MEMORY_CACHE_SIZE = 64
+
+# Files made with tempfile.mkstemp are only readable by their owner; binary gene matrices get the usual permissions
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+def openGeneMatrix(fileName, cache=None, mmap=None):
     '''Opens a gene matrix file and returns the feature labels, gene labels and gene matrix
-    Input: Path of file to be opened (as a string)
+    Files ending in .npy are opened as binary gene matrices, and files ending in .gz as gzipped text. Text files are
+    loaded from their binary cache if it is up to date, and otherwise parsed and cached (unless cache is False, or
+    CACHE_GENE_MATRICES is False)
+    Input: Path of file to be opened (as a string), whether to use the binary cache, whether to memory-map binaries
+    (read-only; defaults to MMAP_GENE_MATRICES)
     Output: feature labels, gene labels, and gene matrix'''
-    file = open(fileName)
+    if mmap is None:
+        mmap = MMAP_GENE_MATRICES
+    with instrument.stage("io/read"):
+        if MEMORY_CACHE is None:
+            return readGeneMatrix(fileName, cache, mmap)
+
+        # Keep the most recently used matrices in memory, dropping older versions of the same file
+        path = os.path.abspath(fileName)
+        key = (path, tuple(sourceStamp(fileName)), cache, mmap)
+        if key in MEMORY_CACHE:
+            MEMORY_CACHE.move_to_end(key)
+            return MEMORY_CACHE[key]
+        for old in [old for old in MEMORY_CACHE if old[0] == path]:
+            del MEMORY_CACHE[old]
+        headers, genelist, genematrix = readGeneMatrix(fileName, cache, mmap)
+        # Matrices are shared between callers, so they must not be modified
+        genematrix.setflags(write=False)
+        MEMORY_CACHE[key] = (headers, genelist, genematrix)
+        while len(MEMORY_CACHE) > MEMORY_CACHE_SIZE:
+            MEMORY_CACHE.popitem(last=False)
+        return MEMORY_CACHE[key]
+
+def readGeneMatrix(fileName, cache=None, mmap=False):
+    '''Reads a gene matrix file (see openGeneMatrix), without the in-memory cache'''
+    if fileName.endswith(BINARY_EXTENSION):
+        return openBinaryGeneMatrix(fileName, mmap=mmap)
+
+    if cache is None:
+        cache = CACHE_GENE_MATRICES
+    if cache:
+        source = sourceStamp(fileName)
+        try:
+            return openBinaryGeneMatrix(fileName + BINARY_EXTENSION, mmap=mmap, source=source)
+        except (IOError, OSError, ValueError):
+            pass
+
+    if fileName.endswith(".gz"):
+        file = gzip.open(fileName, "rt")
+    else:
+        file = open(fileName)
     list = csv.reader(file, delimiter='\t')
     matrix = np.array([row for row in list])
 
@@ -41,22 +109,135 @@ def openGeneMatrix(fileName):
         pass
 
     file.close()
+    instrument.count(parsed_rows=len(genelist))
+
+    # Only numeric matrices can be cached
+    if cache and genematrix.dtype == np.float32:
+        try:
+            packageBinaryGeneMatrix(fileName + BINARY_EXTENSION, headers, genelist, genematrix, source=source)
+        except (IOError, OSError):
+            pass
+    # Memory-mapped matrices are read-only, so parsed matrices are too, whether or not a binary cache exists yet
+    if mmap:
+        genematrix.setflags(write=False)
     return headers, genelist, genematrix
 
-def packageGeneMatrix(fileName, headers, genelist, genematrix):
+def hash_file(path):
+    '''Returns the sha256 hex digest of the contents of a file.'''
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+def sourceStamp(fileName):
+    '''Returns the size and modification time of a file, used to check if its binary cache is up to date'''
+    stat = os.stat(fileName)
+    return [stat.st_size, stat.st_mtime]
+
+def openBinaryGeneMatrix(fileName, mmap=False, source=None):
+    '''Opens a binary gene matrix and returns the feature labels, gene labels and gene matrix
+    If a source stamp is given, raises a ValueError if the binary was not made from a source with the same stamp
+    Input: Path of the .npy file, whether to memory-map the matrix (read-only), source stamp
+    Output: feature labels, gene labels, and gene matrix'''
+    with open(fileName + ".json") as f:
+        labels = json.load(f)
+    if source is not None and labels.get("source") != source:
+        raise ValueError("Binary gene matrix " + fileName + " is out of date")
+
+    genematrix = np.load(fileName, mmap_mode='r' if mmap else None)
+    if genematrix.shape != (len(labels["genes"]), len(labels["headers"]) - 1):
+        raise ValueError("Binary gene matrix " + fileName + " does not match its labels")
+    return np.array(labels["headers"]), np.array(labels["genes"]), genematrix
+
+def packageBinaryGeneMatrix(fileName, headers, genelist, genematrix, source=None):
+    '''Writes the feature labels, gene labels and gene matrix as a binary gene matrix (see openBinaryGeneMatrix)
+    Input: Path of the .npy file to be written to, feature labels, gene labels, gene matrix, optional source stamp
+    Output: Writes to path of file, and to path of file + ".json"'''
+    # Write to temporary files and move them into place, labels last, so readers never see a partial matrix. The
+    # temporary files are unique, so processes caching the same matrix at the same time don't write to the same file.
+    directory = os.path.dirname(os.path.abspath(fileName))
+    fd, tmp = tempfile.mkstemp(prefix=".tmp_", dir=directory)
+    try:
+        os.chmod(tmp, 0o666 & ~_UMASK)
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, np.asarray(genematrix, dtype=np.float32))
+        os.replace(tmp, fileName)
+
+        labels = {"headers": [str(header) for header in headers], "genes": [str(gene) for gene in genelist]}
+        if source is not None:
+            labels["source"] = source
+        fd, tmp = tempfile.mkstemp(prefix=".tmp_", dir=directory)
+        os.chmod(tmp, 0o666 & ~_UMASK)
+        with os.fdopen(fd, "w") as f:
+            json.dump(labels, f)
+        os.replace(tmp, fileName + ".json")
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def indexGeneList(genelist):
+    '''Builds an index from each gene to its row in a gene list. If a gene occurs more than once, the first
+    occurrence wins.
+    Input: gene labels
+    Output: dictionary from gene to row, and sorted list of the genes that occur more than once'''
+    index = {}
+    duplicates = set()
+    for row, gene in enumerate(genelist):
+        if gene in index:
+            duplicates.add(gene)
+        else:
+            index[gene] = row
+    return index, sorted(duplicates)
+
+def lookupGenes(index, genes):
+    '''Looks up the rows of genes in an index built by indexGeneList
+    Input: index, genes to look up
+    Output: array of the row of each gene (-1 for genes not in the index)'''
+    return np.array([index.get(gene, -1) for gene in genes], dtype=np.int64)
+
+def formatGeneMatrix(genematrix, float_format=None, nan="nan"):
+    '''Formats a block of a gene matrix as strings
+    Input: gene matrix, printf-style format for floats (None formats each value like str()), string for NaNs
+    Output: 2D array of strings'''
+    if float_format is None:
+        strings = genematrix.astype(str)
+    else:
+        strings = np.char.mod(float_format, genematrix)
+    if genematrix.dtype.kind == 'f':
+        strings[np.isnan(genematrix)] = nan
+    return strings
+
+def packageGeneMatrix(fileName, headers, genelist, genematrix, float_format=None, nan="nan", block_size=1024):
     '''Combines the feature labels, gene labels and gene matrix and writes to output
-    Input: Path of file to be written to, feature labels, gene labels, and gene matrix
+    Input: Path of file to be written to, feature labels, gene labels, and gene matrix, printf-style format for
+    floats (e.g. "%.6g"; by default values are written like str()), string for NaNs, rows to format at a time
+    Files ending in .npy are written as binary gene matrices, and files ending in .gz are gzipped
     Output: Writes to path of file'''
-    file = open(fileName, "w")
-    file.truncate()
-
-    file.write('\t'.join(headers) + '\n')
-    for i in range(0, genematrix.shape[0]):
-        file.write(genelist[i] + '\t')
-        for j in genematrix[i][:-1]:
-            file.write((str(j)) + '\t')
-        file.write(str(genematrix[i][-1]))
-        file.write('\n')
-
-    print("Written to file " + fileName)
-    file.close()
\ No newline at end of file
+    with instrument.stage("io/write", rows=len(genelist)):
+        if fileName.endswith(BINARY_EXTENSION):
+            packageBinaryGeneMatrix(fileName, headers, genelist, genematrix)
+            print("Written to file " + fileName)
+            return
+
+        if fileName.endswith(".gz"):
+            file = gzip.open(fileName, "wt")
+        else:
+            file = open(fileName, "w", buffering=1 << 20)
+
+        # Format and write block_size rows at a time
+        file.write('\t'.join(headers) + '\n')
+        genematrix = np.asarray(genematrix)
+        for start in range(0, genematrix.shape[0], block_size):
+            end = min(start + block_size, genematrix.shape[0])
+            strings = formatGeneMatrix(genematrix[start:end], float_format, nan).tolist()
+            file.write(''.join(genelist[i] + '\t' + '\t'.join(strings[i - start]) + '\n' for i in range(start, end)))
+
+        print("Written to file " + fileName)
+        file.close()
+
+
+def add_format_argument(parser):
+    '''Adds the --float-format option (see packageGeneMatrix) to the argument parser of a script'''
+    parser.add_argument("--float-format", help="printf-style format to write values with (e.g. %%.6g); by default "
+                                               "values are written at full precision", type=str, default=None)